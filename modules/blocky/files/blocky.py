@@ -29,6 +29,7 @@ import sys
 import argparse
 import syslog
 import copy
+import bisect
 
 DEBUG = False
 CONFIG = None
@@ -36,9 +37,25 @@ SYSLOG = None
 MAX_IPTABLES_TRIES = 10
 IPTABLES_EXEC = '/sbin/iptables'
 IP6TABLES_EXEC = '/sbin/ip6tables'
+IPTABLES_RESTORE_EXEC = '/sbin/iptables-restore'
+IP6TABLES_RESTORE_EXEC = '/sbin/ip6tables-restore'
+IPSET_EXEC = '/sbin/ipset'
+IPSET = False # Ban through ipsets instead of one iptables rule per ban?
+IPSETS = {4: 'blocky4', 6: 'blocky6'}
+IPSET_MAXELEM = 262144
 LAST_UPLOAD = 0
 UPLOAD_FREQUENCY = 180
 
+# Lines of iptables --list, ip6tables --list (no 'option' column) and ipset save
+IPTABLES_LINE = re.compile(r"^(\d+)\s+([A-Z]+)\s+(all|tcp|udp)\s+(\S+)\s+([0-9a-f.:/]+)\s+([0-9a-f.:/]+)\s*(.*?)$")
+IP6TABLES_LINE = re.compile(r"^(\d+)\s+([A-Z]+)\s+(all|tcp|udp)\s+([0-9a-f.:/]+)\s+([0-9a-f.:/]+)\s*(.*?)$")
+IPSET_LINE = re.compile(r"^add \S+ ([0-9a-f.:/]+)")
+RULE_NUMBER = re.compile(r"^(\d+)\s")
+
+# How many rules each (chain, IP version) had when getbans() last listed it,
+# counting those IPTABLES_LINE does not match, kept up to date by reconcile()
+CHAIN_RULES = {}
+
 def getbans(chain = 'INPUT'):
    """ Gets a list of all bans in a chain """
    banlist = []
@@ -56,8 +73,12 @@ def getbans(chain = 'INPUT'):
             continue
          time.sleep(1) # write lock, probably
       if out:
+         CHAIN_RULES[(chain, 4)] = 0
          for line in out.split("\n"):
-            m = re.match(r"^(\d+)\s+([A-Z]+)\s+(all|tcp|udp)\s+(\S+)\s+([0-9a-f.:/]+)\s+([0-9a-f.:/]+)\s*(.*?)$", line)
+            n = RULE_NUMBER.match(line)
+            if n:
+               CHAIN_RULES[(chain, 4)] = max(CHAIN_RULES[(chain, 4)], int(n.group(1)))
+            m = IPTABLES_LINE.match(line)
             if m:
                ln = m.group(1)
                action = m.group(2)
@@ -95,9 +116,13 @@ def getbans(chain = 'INPUT'):
             continue
          time.sleep(1) # write lock, probably
       if out:
+         CHAIN_RULES[(chain, 6)] = 0
          for line in out.split("\n"):
+            n = RULE_NUMBER.match(line)
+            if n:
+               CHAIN_RULES[(chain, 6)] = max(CHAIN_RULES[(chain, 6)], int(n.group(1)))
             # Unlike ipv4 iptables, the 'option' thing is blank here, so omit it
-            m = re.match(r"^(\d+)\s+([A-Z]+)\s+(all|tcp|udp)\s+([0-9a-f.:/]+)\s+([0-9a-f.:/]+)\s*(.*?)$", line)
+            m = IP6TABLES_LINE.match(line)
             if m:
                ln = m.group(1)
                action = m.group(2)
@@ -148,10 +173,19 @@ def iptables(ip, action):
 
 def ban(ip):
    """ Bans an IP or CIDR block generically """
+   if IPSET:
+      net = asnet(ip)
+      return ipset(['add', IPSETS[net.version], str(net.cidr), '-exist'])
    if iptables(ip, '-A'):
       return True
    return False
 
+def unban(entry):
+   """ Unbans a ban as found by getbans() or getsets() """
+   if entry['chain'] in IPSETS.values():
+      return ipset(['del', entry['chain'], entry['source'], '-exist'])
+   return unban_line(entry['source'], entry['linenumber'], chain = entry.get('chain', 'INPUT'))
+
 def unban_line(ip, linenumber, chain = 'INPUT'):
     """ Unbans an IP or block by line number """
     if not linenumber:
@@ -174,33 +208,188 @@ def unban_line(ip, linenumber, chain = 'INPUT'):
         return False
     return True
 
+def ipset(args, script = None):
+   """ Runs ipset with a list of arguments, feeding it a script on stdin if
+   given, returns true if succeeded, false otherwise """
+   try:
+      proc = subprocess.Popen([IPSET_EXEC] + args, stdin = subprocess.PIPE, stdout = open(os.devnull, 'wb'), stderr = subprocess.PIPE, universal_newlines = True)
+      out, err = proc.communicate(script)
+   except OSError as err:
+      print("%s not found or inaccessible: %s" % (IPSET_EXEC, err))
+      return False
+   if proc.returncode != 0:
+      syslog.syslog(syslog.LOG_WARNING, "ipset %s failed: %s" % (args[0], err.strip()))
+      return False
+   return True
+
+def ipset_create(name, version):
+   """ ipset command for creating a blocky set, unless it already exists """
+   return "create %s hash:net family %s maxelem %u -exist" % (name, 'inet' if version == 4 else 'inet6', IPSET_MAXELEM)
+
+def ipset_rules():
+   """ Makes sure both blocky sets exist, each dropped by a single rule in INPUT """
+   ipset(['restore'], "\n".join(ipset_create(name, version) for version, name in sorted(IPSETS.items())) + "\n")
+   for version, name in sorted(IPSETS.items()):
+      exe = IPTABLES_EXEC if version == 4 else IP6TABLES_EXEC
+      rule = ["INPUT", "-m", "set", "--match-set", name, "src", "-j", "DROP", "-m", "comment", "--comment", "Banned by Blocky/2.0"]
+      try:
+         subprocess.check_call([exe, '-C'] + rule, stderr=open(os.devnull, 'wb'))
+      except subprocess.CalledProcessError: # Not there yet, add it
+         try:
+            subprocess.check_call([exe, '-A'] + rule, stderr=open(os.devnull, 'wb'))
+         except subprocess.CalledProcessError:
+            syslog.syslog(syslog.LOG_WARNING, "Could not add the DROP rule for the %s ipset!" % name)
+      except OSError as err:
+         print("%s not found or inaccessible: %s" % (exe, err))
+
+def getsets():
+   """ Gets a list of all bans in the blocky ipsets, as getbans() would list them """
+   banlist = []
+   for version, name in sorted(IPSETS.items()):
+      try:
+         out = subprocess.check_output([IPSET_EXEC, 'save', name], stderr = subprocess.STDOUT, universal_newlines = True)
+      except subprocess.CalledProcessError: # no such set (yet)
+         continue
+      except OSError as err:
+         print("%s not found or inaccessible: %s" % (IPSET_EXEC, err))
+         break
+      for line in out.split("\n"):
+         m = IPSET_LINE.match(line)
+         if m:
+            source = m.group(1)
+            entry = {
+               'chain': name,
+               'linenumber': None,
+               'action': 'DROP',
+               'protocol': 'all',
+               'option': '---',
+               'source': source,
+               'asNet': netaddr.IPNetwork(source),
+               'destination': '0.0.0.0/0' if version == 4 else '::/0',
+               'extensions': 'match-set %s src' % name,
+            }
+            banlist.append(entry)
+   return banlist
+
+def ipset_load(nets):
+   """ Replaces the contents of the blocky sets with a list of IPNetworks.
+   Each set is filled anew under a temporary name and then swapped into
+   place, so packets never see a half-loaded set """
+   lines = []
+   for version, name in sorted(IPSETS.items()):
+      tmp = "%s-new" % name
+      lines.append(ipset_create(name, version))
+      lines.append(ipset_create(tmp, version))
+      lines.append("flush %s" % tmp)
+      for net in nets:
+         if net.version == version and net.prefixlen: # hash:net can't hold /0
+            lines.append("add %s %s -exist" % (tmp, net.cidr))
+      lines.append("swap %s %s" % (tmp, name))
+      lines.append("destroy %s" % tmp)
+   return ipset(['restore'], "\n".join(lines) + "\n")
+
+
+def asnet(ip):
+   """ Turns an IP or CIDR block into an IPNetwork (a single IP being a /32 or /128) """
+   if '/' in ip:
+      return netaddr.IPNetwork(ip)
+   if ':' in ip:
+      return netaddr.IPNetwork("%s/128" % ip) # IPv6
+   return netaddr.IPNetwork("%s/32" % ip)     # IPv4
+
+
+class BanIndex:
+   """ Binary prefix trie over IPv4 and IPv6 networks, one per family.
+   Every node is [zero-child, one-child, entries]; a network lives at the
+   node its first <prefixlen> bits lead to, so exact, contains and
+   contained-in lookups only walk as many nodes as the prefix is long. """
+   def __init__(self, entries = None):
+      self.roots = {4: [None, None, []], 6: [None, None, []]}
+      self.entries = []
+      for entry in entries or []:
+         self.add(entry)
+   
+   def __len__(self):
+      return len(self.entries)
+   
+   def bits(self, net):
+      """ Yields the first <prefixlen> bits of a network, most significant first """
+      first = net.first
+      width = 32 if net.version == 4 else 128
+      for i in range(width - 1, width - 1 - net.prefixlen, -1):
+         yield (first >> i) & 1
+   
+   def add(self, entry, net = None):
+      """ Adds an entry (anything dict-like with a source), keyed by its network """
+      if net is None:
+         net = entry.get('asNet') or asnet(entry['source'])
+      node = self.roots[net.version]
+      for bit in self.bits(net):
+         if not node[bit]:
+            node[bit] = [None, None, []]
+         node = node[bit]
+      node[2].append(entry)
+      self.entries.append(entry)
+   
+   def walk(self, net):
+      """ Returns the node for a network, or None if nothing is stored at or below it """
+      node = self.roots[net.version]
+      for bit in self.bits(net):
+         node = node[bit]
+         if not node:
+            return None
+      return node
+   
+   def exact(self, net):
+      """ Entries for exactly this network """
+      node = self.walk(net)
+      return list(node[2]) if node else []
+   
+   def within(self, net):
+      """ Entries for this network or any network inside it """
+      lines = []
+      node = self.walk(net)
+      todo = [node] if node else []
+      while todo:
+         node = todo.pop()
+         lines.extend(node[2])
+         todo.extend(child for child in node[:2] if child)
+      return lines
+   
+   def containing(self, net):
+      """ Entries for this network or any block containing it,
+      narrowest first """
+      node = self.roots[net.version]
+      lines = list(node[2])
+      for bit in self.bits(net):
+         node = node[bit]
+         if not node:
+            break
+         lines[:0] = node[2] # narrowest (exact) match first
+      return lines
+
+
 def inlist(banlist, ip):
    """ Check if an IP or CIDR is listed in iptables,
-   either by itself or contained within a block (or the reverse) """
-   lines = []
+   either by itself or contained within a block (or the reverse).
+   banlist is a BanIndex, or a plain list of bans to index first """
    if '/0' in ip: # DO NOT WANT
-      return lines
-   # First, check verbatim
-   for entry in banlist:
-      if entry['source'] == ip:
-         lines.append(entry)
-   # Check if block, then check for matches within
+      return []
+   if not isinstance(banlist, BanIndex):
+      banlist = BanIndex(banlist)
+   me = asnet(ip)
+   # Blocks: anything within it. Single IPs: any block holding it, bar /0.
    if '/' in ip:
-      me = netaddr.IPNetwork(ip)
-      for entry in banlist:
-         them = entry['asNet']
-         if them in me:
-            lines.append(entry)
-   
-   # Then the reverse; IP found within blocks?
-   else:
-      me = netaddr.IPAddress(ip)
-      for entry in banlist:
-         if '/' in entry['source'] and '/0' not in entry['source']: # blocks, but not /0
-            them = entry['asNet']
-            if me in them:
-               lines.append(entry)
-   return lines
+      return banlist.within(me)
+   return [entry for entry in banlist.containing(me) if entry['asNet'].prefixlen]
+
+
+def whitelisted(whitelist, block):
+   """ Returns the whitelisted block that overlaps a block (either way), if any """
+   found = whitelist.containing(block) or whitelist.within(block)
+   if found:
+      return found[0]['asNet']
+   return None
 
 
 def note_ban(me, entry):
@@ -229,15 +418,138 @@ def note_unban(me, entry):
       pass # If it fails, it fails - we'll continue anyway
            # Not sure if we should even syslog that..
 
+def getlocal(chains):
+   """ Gets all bans in place here: those in the iptables chains, and those
+   in the blocky ipsets if we use them """
+   mylist = []
+   for chain in chains:
+      mylist += getbans(chain)
+   if IPSET:
+      mylist += getsets()
+   return mylist
+
+def newban(ip, block, reason = None):
+   """ A ban that is yet to be added, as getbans() or getsets() will list it """
+   v4 = block.version == 4
+   chain = IPSETS[block.version] if IPSET else 'INPUT'
+   return {
+      'chain': chain,
+      'linenumber': None,
+      'action': 'DROP',
+      'protocol': 'all',
+      'option': '--' if v4 else '---',
+      'source': ip,
+      'asNet': block,
+      'destination': '0.0.0.0/0' if v4 else '::/0',
+      'extensions': 'match-set %s src' % chain if IPSET else '/* Banned by Blocky/2.0 */',
+      'reason': reason or "No reason specified",
+   }
+
+def iptables_restore(exe, batch):
+   """ Feeds a batch of rule changes to iptables-restore (or ip6tables-restore),
+   leaving all other rules alone, returns true if succeeded, false otherwise """
+   try:
+      proc = subprocess.Popen([exe, '--noflush'], stdin = subprocess.PIPE, stdout = open(os.devnull, 'wb'), stderr = subprocess.PIPE, universal_newlines = True)
+      out, err = proc.communicate(batch)
+   except OSError as err:
+      print("%s not found or inaccessible: %s" % (exe, err))
+      return False
+   if proc.returncode != 0:
+      syslog.syslog(syslog.LOG_WARNING, "%s failed: %s" % (exe, err.strip()))
+      return False
+   return True
+
+def reconcile(mylist, unbans, bans):
+   """ Takes a cycle's worth of unbans (entries in mylist) and bans (from
+   newban()) off and onto the firewall in one go, then brings mylist up to
+   date without listing iptables again. iptables rules change in a single
+   iptables-restore --noflush batch per address family, ipsets in a single
+   reload. Returns the unbans and bans that took effect """
+   unbanned = []
+   banned = []
+   setnames = IPSETS.values()
+   
+   # Set members: reload both sets with what should be in them from now on
+   setunbans = [entry for entry in unbans if entry['chain'] in setnames]
+   setbans = [entry for entry in bans if entry['chain'] in setnames]
+   if setunbans or setbans:
+      gone = set(id(entry) for entry in setunbans)
+      nets = [entry['asNet'] for entry in mylist + setbans if entry['chain'] in setnames and id(entry) not in gone]
+      if ipset_load(nets):
+         unbanned += setunbans
+         banned += setbans
+      else:
+         syslog.syslog(syslog.LOG_WARNING, "Could not load %u bans into ipset!" % len(nets))
+   
+   # iptables rules: delete from the bottom of each chain up, so the line
+   # numbers we listed still hold, then append the new bans
+   for version, restore in ((4, IPTABLES_RESTORE_EXEC), (6, IP6TABLES_RESTORE_EXEC)):
+      dels = [entry for entry in unbans if entry['chain'] not in setnames and entry['asNet'].version == version]
+      dels.sort(key = lambda entry: (entry['chain'], -int(entry['linenumber'])))
+      adds = [entry for entry in bans if entry['chain'] not in setnames and entry['asNet'].version == version]
+      if not dels and not adds:
+         continue
+      batch = ["*filter"]
+      batch += ["-D %s %s" % (entry['chain'], entry['linenumber']) for entry in dels]
+      batch += ['-A %s -s %s -j DROP -m comment --comment "Banned by Blocky/2.0"' % (entry['chain'], entry['source']) for entry in adds]
+      batch.append("COMMIT")
+      if DEBUG:
+         print("Would have fed this to %s here:\n%s" % (restore, "\n".join(batch)))
+         continue
+      if iptables_restore(restore, "\n".join(batch) + "\n"):
+         unbanned += dels
+         banned += adds
+      else:
+         # One bad line fails the whole batch, so try them one by one instead
+         syslog.syslog(syslog.LOG_WARNING, "Could not apply %u changes through %s, applying them one by one" % (len(dels) + len(adds), restore))
+         for entry in dels:
+            if unban_line(entry['source'], entry['linenumber'], chain = entry['chain']):
+               unbanned.append(entry)
+            else:
+               syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % entry['source'])
+         for entry in adds:
+            if iptables(entry['source'], '-A'):
+               banned.append(entry)
+            else:
+               syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % entry['source'])
+   
+   # Bring mylist up to date: whatever was below a deleted line moves up one,
+   # new bans go at the end of their chain, after every rule in it (not just
+   # those getbans() turned into entries)
+   gone = set(id(entry) for entry in unbanned)
+   deleted = {}
+   for entry in unbanned:
+      if entry['linenumber']:
+         deleted.setdefault((entry['chain'], entry['asNet'].version), []).append(int(entry['linenumber']))
+   for lines in deleted.values():
+      lines.sort()
+   mylist[:] = [entry for entry in mylist if id(entry) not in gone]
+   for entry in mylist:
+      if entry['linenumber']:
+         key = (entry['chain'], entry['asNet'].version)
+         ln = int(entry['linenumber'])
+         ln -= bisect.bisect_left(deleted.get(key, []), ln)
+         entry['linenumber'] = str(ln)
+   for key, lines in deleted.items():
+      CHAIN_RULES[key] = CHAIN_RULES.get(key, 0) - len(lines)
+   for entry in banned:
+      if entry['chain'] not in setnames:
+         key = (entry['chain'], entry['asNet'].version)
+         CHAIN_RULES[key] = CHAIN_RULES.get(key, 0) + 1
+         entry['linenumber'] = str(CHAIN_RULES[key])
+      mylist.append(entry)
+   return unbanned, banned
+
 def run_legacy_checks():
    """ Runs checks using the legacy blocky UI server (mod_lua) """
    apiurl = CONFIG['server']['legacyurl']
    actions = []
-   mylist = []
    ychains = CONFIG.get('iptables', {}).get('chains')
    chains = ychains if ychains else ['INPUT']
-   for chain in chains:
-      mylist += getbans(chain)
+   if IPSET:
+      ipset_rules()
+   mylist = getlocal(chains)
+   myindex = BanIndex(mylist)
    print("Found %u bans in iptables" % len(mylist))
    
    try:
@@ -246,7 +558,11 @@ def run_legacy_checks():
    except:
       syslog.syslog(syslog.LOG_WARNING, "Could not retrieve blocky actions list from %s - server down??!" % apiurl)
    
-   whitelist = [] # Things we are unbanning, and thus shouldn't just ban right again
+   whitelist = BanIndex() # Things we are unbanning, and thus shouldn't just ban right again
+   unbans = [] # Changes to make, all in one go at the end
+   bans = []
+   seen = set() # ids of bans already queued for removal
+   pending = set() # ids of bans queued for adding
    
    # For each action element, find out what to do, and who to do it to.
    for action in actions:
@@ -258,23 +574,17 @@ def run_legacy_checks():
             ip = action.get('ip')
             if ip:
                ip = ip.strip()
-               block = None
-               if '/' in ip:
-                  block = netaddr.IPNetwork(ip)
-               else:
-                  if ':' in ip:
-                     block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-                  else:
-                     block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-               whitelist.append(block)
-               found = inlist(mylist, ip)
-               if found:
-                  entry = found[0]
-                  syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, entry['linenumber'], entry['source']))
-                  if not unban_line(ip, found[0]['linenumber']):
-                     syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % ip)
+               block = asnet(ip)
+               whitelist.add({'source': ip, 'asNet': block}, block)
+               for entry in inlist(myindex, ip):
+                  if id(entry) in seen:
+                     continue
+                  seen.add(id(entry))
+                  if id(entry) in pending: # Banned earlier on in this list, never mind
+                     bans = [other for other in bans if other is not entry]
                   else:
-                     mylist = getbans() # Refresh after action succeeded
+                     syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found in %s as %s)" % (ip, entry['chain'], entry['source']))
+                     unbans.append(entry)
                      
       # Ban request?
       elif 'ip' in action:
@@ -283,38 +593,35 @@ def run_legacy_checks():
             if ip:
                ip = ip.strip() # backwards compat
                banit = True
-               block = None
-               if '/' in ip:
-                  block = netaddr.IPNetwork(ip)
-               else:
-                  if ':' in ip:
-                     block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-                  else:
-                     block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-               for wblock in whitelist:
-                  if block in wblock or wblock in block:
-                     syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
-                     banit = False
+               block = asnet(ip)
+               wblock = whitelisted(whitelist, block)
+               if wblock:
+                  syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
+                  banit = False
                if banit:
-                  found = inlist(mylist, ip)
+                  # Bans queued for removal no longer cover it
+                  found = [other for other in inlist(myindex, ip) if id(other) not in seen]
                   if not found:
                      reason = action.get('reason', "No reason specified")
                      syslog.syslog(syslog.LOG_INFO, "Adding %s to block list; %s" % (ip, reason))
-                     if not ban(ip):
-                        syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % ip)
-                     else:
-                        mylist = getbans() # Refresh after action succeeded
-                        
+                     entry = newban(ip, block, reason)
+                     myindex.add(entry, block)
+                     bans.append(entry)
+                     pending.add(id(entry))
+   
+   reconcile(mylist, unbans, bans)
+
 def run_new_checks():
    """ Runs the blocky process using the modern UI server """
    global LAST_UPLOAD
    
    # First, get our rules and post 'em to the server
-   mylist = []
    ychains = CONFIG.get('iptables', {}).get('chains')
    chains = ychains if ychains else ['INPUT']
-   for chain in chains:
-      mylist += getbans(chain)
+   if IPSET:
+      ipset_rules()
+   mylist = getlocal(chains)
+   myindex = BanIndex(mylist)
    print("Found %u bans in iptables" % len(mylist))
    
    if LAST_UPLOAD < (time.time() - UPLOAD_FREQUENCY):
@@ -338,7 +645,7 @@ def run_new_checks():
 
    # Then, get applicable actions from the server
    whitelist = []
-   whiteblocks = [] # same as above, but as IPNetwork classes
+   whiteblocks = BanIndex() # same as above, but indexed by IPNetwork
    banlist = []
    try:
       whiteurl = "%s/whitelist" % CONFIG['server']['apiurl']
@@ -351,6 +658,12 @@ def run_new_checks():
    except:
       syslog.syslog(syslog.LOG_WARNING, "Could not fetch whitelist entries at %s - server down?" % banurl)
    
+   # What we want in place is the server's bans minus the whitelist, on top
+   # of what is already here; work out the difference, then apply it in one go
+   unbans = []
+   bans = []
+   seen = set() # ids of bans already queued for removal
+   
    # First, check if we've banned someone on the whitelist
    for entry in whitelist:
       ip = entry.get('ip')
@@ -358,24 +671,13 @@ def run_new_checks():
       target = entry.get('target', '*')
       if target == '*' or target == CONFIG['client']['hostname']:
          if ip:
-            block = None
-            if '/' in ip:
-               block = netaddr.IPNetwork(ip)
-            else:
-               if ':' in ip:
-                  block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-               else:
-                  block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-            whiteblocks.append(block)
-            found = inlist(mylist, ip)
-            if found:
-               entry = found[0]
-               syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, entry['linenumber'], entry['source']))
-               if not unban_line(ip, entry['linenumber'], chain = entry.get('chain', 'INPUT')):
-                  syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % ip)
-               else:
-                  note_unban(CONFIG['client']['hostname'], found[0])
-                  mylist = getbans() # Refresh after action succeeded
+            block = asnet(ip)
+            whiteblocks.add({'source': ip, 'asNet': block}, block)
+            for found in inlist(myindex, ip):
+               if id(found) not in seen:
+                  seen.add(id(found))
+                  syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found in %s as %s)" % (ip, found['chain'], found['source']))
+                  unbans.append(found)
    
    # Then process bans
    for entry in banlist:
@@ -385,30 +687,25 @@ def run_new_checks():
       if ip:
          if target == '*' or target == CONFIG['client']['hostname']:
             banit = True
-            block = None
-            if '/' in ip:
-               block = netaddr.IPNetwork(ip)
-            else:
-               if ':' in ip:
-                  block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-               else:
-                  block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-            for wblock in whiteblocks:
-               if block in wblock or wblock in block:
-                  syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
-                  banit = False
+            block = asnet(ip)
+            wblock = whitelisted(whiteblocks, block)
+            if wblock:
+               syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
+               banit = False
             if banit:
-               found = inlist(mylist, ip)
+               # Bans queued for removal no longer cover it
+               found = [other for other in inlist(myindex, ip) if id(other) not in seen]
                if not found:
-                  reason = entry.get('reason', "No reason specified")
                   syslog.syslog(syslog.LOG_INFO, "Adding %s to block list; %s" % (ip, reason))
-                  if not ban(ip):
-                     syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % ip)
-                  else:
-                     mylist = getbans() # Refresh after action succeeded
-                     found = inlist(mylist, ip)
-                     if found: # make sure we have it in iptables now
-                        note_ban(CONFIG['client']['hostname'], found[0])
+                  mine = newban(ip, block, reason)
+                  myindex.add(mine, block)
+                  bans.append(mine)
+   
+   unbanned, banned = reconcile(mylist, unbans, bans)
+   for entry in unbanned:
+      note_unban(CONFIG['client']['hostname'], entry)
+   for entry in banned:
+      note_ban(CONFIG['client']['hostname'], entry)
    # All done for this time!
 
 def psyslog(a,b):
@@ -436,6 +733,49 @@ def run_daemon(stdout = False):
          return
       time.sleep(CONFIG['client'].get('interval', 60))
 
+def benchmark(n):
+   """ Times BanIndex lookups against a linear scan, for n local bans and
+   n server bans (a mix of IPv4/IPv6 addresses and blocks) """
+   import random
+   random.seed(n)
+   def fake():
+      r = random.random()
+      if r < 0.6:
+         return str(netaddr.IPAddress(random.getrandbits(32)))
+      elif r < 0.8:
+         return str(netaddr.IPNetwork((random.getrandbits(32), random.randint(16, 28))).cidr)
+      elif r < 0.95:
+         return str(netaddr.IPAddress(random.getrandbits(128), 6))
+      return str(netaddr.IPNetwork((random.getrandbits(128), random.randint(32, 64)), version = 6).cidr)
+   mylist = []
+   for i in range(n):
+      source = fake()
+      mylist.append({'chain': 'INPUT', 'linenumber': str(i+1), 'source': source, 'asNet': netaddr.IPNetwork(source)})
+   # Half of the server bans are already banned here, the rest are new
+   queries = [entry['source'] for entry in random.sample(mylist, n // 2)] + [fake() for i in range(n - n // 2)]
+   
+   now = time.time()
+   myindex = BanIndex(mylist)
+   built = time.time() - now
+   now = time.time()
+   found = 0
+   for ip in queries:
+      if inlist(myindex, ip):
+         found += 1
+   indexed = time.time() - now
+   print("Indexed %u bans in %.3fs, looked up %u IPs/blocks in %.3fs (%u already banned)" % (n, built, n, indexed, found))
+   
+   # The old way: a netaddr comparison against every ban, for a sample of the queries
+   sample = queries[:max(1, min(n, 200))]
+   now = time.time()
+   for ip in sample:
+      me = asnet(ip)
+      lines = [entry for entry in mylist if entry['asNet'] in me or ('/' not in ip and me in entry['asNet'] and entry['asNet'].prefixlen)]
+      assert len(lines) == len(inlist(myindex, ip)), ip
+   linear = (time.time() - now) * len(queries) / len(sample)
+   print("A linear scan would take about %.1fs for the same lookups (%.0fx slower)" % (linear, linear / max(indexed, 0.000001)))
+
+
 def base_parser():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("-x", "--user", help="not used (legacy compat)")
@@ -445,11 +785,17 @@ def base_parser():
     arg_parser.add_argument("-d", "--daemonize", action = 'store_true', help="Run blocky as a daemon")
     arg_parser.add_argument("-s", "--stop", action = 'store_true', help="Stop blocky daemon")
     arg_parser.add_argument("-f", "--foreground", action = 'store_true', help="Run blocky in the foreground (debugging)")
+    arg_parser.add_argument("--benchmark", type = int, metavar = 'N', help="Time ban lookups with N bans in place and N more coming in, then exit")
     return arg_parser
 
 
 def start_client():
-   global CONFIG
+   global CONFIG, IPSET, IPSET_MAXELEM
+   args = base_parser().parse_args()
+   if args.benchmark:
+      benchmark(args.benchmark)
+      return
+   
    # Figure out who we are
    me = socket.getfqdn()
    
@@ -460,10 +806,17 @@ def start_client():
    if 'hostname' not in CONFIG['client']:
       CONFIG['client']['hostname'] = me
    
-   # Get current list of bans in iptables, upload it to blocky server
-   l = getbans()
+   # Ban through ipsets? Fall back to plain iptables rules if we can't
+   ycfg = CONFIG.get('ipset') or {}
+   if ycfg.get('enabled'):
+      if os.path.exists(IPSET_EXEC):
+         IPSET = True
+         IPSET_MAXELEM = int(ycfg.get('maxelem', IPSET_MAXELEM))
+      else:
+         print("ipset is enabled but %s was not found, banning through iptables instead" % IPSET_EXEC)
    
-   args = base_parser().parse_args()
+   # Get current list of bans in iptables, upload it to blocky server
+   l = getlocal(['INPUT'])
    
    # CLI unban?
    if args.unban:
@@ -472,9 +825,9 @@ def start_client():
       if found:
          entry = found[0] # Only get the first entry, line numbers will then change ;\
          print("Found a block for %s on line %s in the %s chain (as %s), removing..." % (ip, entry['linenumber'], entry['chain'], entry['source']))
-         if unban_line(entry['linenumber']):
+         if unban(entry):
             print("Refreshing ban list...")
-            l = getbans()
+            l = getlocal(['INPUT'])
       else:
          print("%s wasn't found in iptables, nothing to do" % ip)
       return
@@ -486,6 +839,8 @@ def start_client():
       if found:
          print("%s is already banned here as %s, nothing to do" % (ip, found[0]['source']))
       else:
+         if IPSET:
+            ipset_rules()
          if ban(ip):
             print("IP %s successfully banned using generic ruleset" % ip)
          else:
@@ -29,6 +29,12 @@ class blocky (
         ensure => present;
     }
   }
+  if !defined(Package['ipset']) {
+    package {
+      'ipset' :
+        ensure => present;
+    }
+  }
   if !defined(Python::Pip['pyyaml']) {
     python::pip {
       'pyyaml' :
@@ -19,6 +19,15 @@ import time
 import logging
 import atexit
 import signal
+import collections
+import json
+import copy
+import threading
+import struct
+import random
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 # define a megabyte and gigabyte
 MB = (2 ** 20)
@@ -32,6 +41,21 @@ CONFIG = None
 # Default to checking triggers every N seconds.
 DEFAULT_INTERVAL = 300
 
+# In between, look at the processes rules matched every N seconds, or
+# every M seconds while they are close to a threshold.
+DEFAULT_SAMPLE = 15
+DEFAULT_FAST = 2
+
+# Runlist commands run this many at a time, and are killed after N seconds.
+# A rule does not run its runlist again within N minutes of the start of the
+# scan that last ran it, so with the default, every full scan may run it.
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 60
+DEFAULT_COOLDOWN = 5
+
+# Where to tell what the last scan found, for monitoring
+DEFAULT_STATEFILE = "/var/run/kif.json"
+
 
 # Miscellaneous auxiliary functions
 def notifyEmail(fro, to, subject, msg):
@@ -56,8 +80,8 @@ def notifyHipchat(room, token, msg, notify = False):
 
 
 class ProcessInfo(object):
-    def __init__(self, pid=None):
-        if pid is None:
+    def __init__(self, proc=None, connections=None):
+        if proc is None:
             # This instance will aggregate values across multiple processes,
             # so we'll zero the numerics.
             self.mem = 0
@@ -69,16 +93,33 @@ class ProcessInfo(object):
             self.conns_local = 0
             return
 
-        proc = psutil.Process(pid)
-        self.mem = proc.memory_info().rss
-        self.mempct = proc.memory_percent()
-        self.fds = proc.num_fds()
-        self.age = time.time() - proc.create_time()
-        self.state = proc.status()
-
-        self.conns = len(proc.connections())
+        # Everything is read in one go, so psutil only has to go through
+        # /proc/<pid>/stat and friends once for this process.
+        self.pid = proc.pid
+        self.error = None
+        with proc.oneshot():
+            self.cmdline = proc.cmdline() or [proc.name()]
+            self.cmdline = [c for c in self.cmdline if len(c) > 0]
+            self.username = proc.username()
+            self.state = proc.status()
+            try:
+                self.mem = proc.memory_info().rss
+                self.mempct = proc.memory_percent()
+                self.created = proc.create_time()
+                self.age = time.time() - self.created
+                if connections:
+                    self.fds, self.conns, self.conns_local = connections.count(self.pid)
+                    return
+                self.fds = proc.num_fds()
+                connections = proc.connections()
+            except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess, OSError) as err:
+                # Still good for matching, just not for analysis.
+                self.error = err
+                return
+
+        self.conns = len(connections)
         self.conns_local = 0
-        for connection in proc.connections():
+        for connection in connections:
             if connection.raddr and connection.raddr[0]:
                 if RE_LOCAL_IP.match(connection.raddr[0]) \
                    or connection.raddr[0] == '::1':
@@ -96,245 +137,480 @@ class ProcessInfo(object):
 RE_LOCAL_IP = re.compile(r'^(10|192|127)\.')
 
 
-def getuser(pid):
-    proc = psutil.Process(pid)
-    return proc.username()
-
-
-# getprocs: Get all processes and their command line stack
-def getprocs():
-    procs = {}
-    for p in psutil.process_iter():
+class ConnectionIndex(object):
+    """Every TCP and UDP socket on the box, read once per scan from
+    /proc/net and matched to processes through the socket inodes in their
+    /proc/<pid>/fd. psutil's connections() reads all of /proc/net again
+    for each process it is asked about, which on a box with many sockets
+    is most of what a scan costs."""
+
+    tables = ('tcp', 'tcp6', 'udp', 'udp6')
+
+    def __init__(self, root = '/proc'):
+        self.root = root
+        self.remotes = {}
+        self.local = {}
+        for table in self.tables:
+            try:
+                with open(os.path.join(root, 'net', table)) as f:
+                    f.readline()
+                    for line in f:
+                        # sl local_address rem_address st ... uid timeout inode
+                        fields = line.split()
+                        self.remotes[fields[9]] = fields[2]
+            except IOError:
+                pass
+
+    def isLocal(self, remote):
+        """Whether a remote address (as /proc/net has it, hex in host byte
+        order) is on the LAN, by the same test ProcessInfo uses."""
+        if remote not in self.local:
+            addr, port = remote.split(':')
+            ip = None
+            if int(port, 16):
+                if len(addr) == 8:
+                    ip = socket.inet_ntoa(struct.pack('=I', int(addr, 16)))
+                else:
+                    words = [int(addr[i:i+8], 16) for i in range(0, 32, 8)]
+                    ip = socket.inet_ntop(socket.AF_INET6, struct.pack('=4I', *words))
+            self.local[remote] = bool(ip and (RE_LOCAL_IP.match(ip) or ip == '::1'))
+        return self.local[remote]
+
+    def count(self, pid):
+        """Returns the number of fds, connections and LAN connections a
+        process has."""
+        fddir = '%s/%u/fd' % (self.root, pid)
+        fds = os.listdir(fddir)
+        conns = 0
+        conns_local = 0
+        for fd in fds:
+            try:
+                target = os.readlink(fddir + '/' + fd)
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                remote = self.remotes.get(target[8:-1])
+                if remote is not None:
+                    conns += 1
+                    if self.isLocal(remote):
+                        conns_local += 1
+        return len(fds), conns, conns_local
+
+
+class Snapshot(object):
+    """All processes on the box and everything the rules may ask about them,
+    collected in a single pass per run. Rules are then matched against this
+    table, through indexes by user, by exact command line and (built as
+    rules ask for them) by command line substring."""
+
+    def __init__(self, procs = None):
+        self.procs = {}
+        self.by_user = {}
+        self.by_cmdline = {}
+        self.by_substring = {}
+        if procs is not None:
+            for info in procs:
+                self.add(info)
+            return
+        connections = ConnectionIndex() if os.path.exists('/proc/net/tcp') else None
+        for proc in psutil.process_iter():
+            try:
+                self.add(ProcessInfo(proc, connections))
+            except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess):
+                print("Could not access process, it might have gone away...")
+                continue
+
+    def add(self, info):
+        if len(info.cmdline) > 0 and len(info.cmdline[0]) > 0:
+            info.cmdstr = " ".join(info.cmdline)
+            self.procs[info.pid] = info
+            self.by_user.setdefault(info.username, []).append(info.pid)
+            self.by_cmdline.setdefault(tuple(info.cmdline), []).append(info.pid)
+
+    def find(self, procid):
+        """Returns the PIDs whose command line contains procid (a string)
+        or is exactly procid (a list)."""
+        if isinstance(procid, list):
+            return self.by_cmdline.get(tuple(procid), [])
+        if procid not in self.by_substring:
+            self.by_substring[procid] = [pid for pid, info in self.procs.items() if info.cmdstr.find(procid) != -1]
+        return self.by_substring[procid]
+
+    def user(self, uid):
+        """Returns the PIDs of processes running as uid (a user name)."""
+        return self.by_user.get(uid, [])
+
+
+def ignored(rule, info):
+    """Whether a process matched by a rule is exempt from it, through its
+    ignore or ignorepidfile settings."""
+    if 'ignore' in rule:
+        if isinstance(rule['ignore'], str) and info.cmdstr == rule['ignore']:
+            return True
+        if isinstance(rule['ignore'], list) and info.cmdline == rule['ignore']:
+            return True
+    if 'ignorepidfile' in rule:
         try:
-            pinfo = p.as_dict(attrs=['pid', 'name', 'username', 'status', 'cmdline'])
-            content = pinfo['cmdline']
-            if not content:
-                content = pinfo['name'] # Fall back if no cmdline present
-            pid = pinfo['pid']
-            if len(content) > 0 and len(content[0]) > 0:
-                content = [c for c in content if len(c) > 0]
-                procs[pid] = content
-        except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess):
-            print("Could not access process, it might have gone away...")
-            continue
-    return procs
+            ppid = int(open(rule['ignorepidfile']).read())
+            if ppid == info.pid:
+                print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
+                return True
+        except Exception as err:
+            print(err)
+    return False
+
+
+
+def memory(value):
+    """Parses an amount of memory such as 500mb or 2gb into bytes."""
+    value = str(value).lower().strip()
+    if value.endswith('gb'):
+        return int(value[:-2]) * GB
+    if value.endswith('mb'):
+        return int(value[:-2]) * MB
+    if value.endswith('kb'):
+        return int(value[:-2]) * 1024
+    return int(value)
+
+
+class Trigger(object):
+    """A trigger of a rule, with its threshold parsed into base units (bytes,
+    percent, seconds or a plain count) once, when kif.yaml is loaded."""
+
+    # trigger: (ProcessInfo attribute, what we tell about it)
+    kinds = {
+        'maxfds': ('fds', "      - Process '%s' is using %u FDs, max allowed is %u"),
+        'maxconns': ('conns', "      - Process '%s' is using %u connections, max allowed is %u"),
+        'maxlocalconns': ('conns_local', "      - Process '%s' is using %u LAN connections, max allowed is %u"),
+        'maxage': ('age', "      - Process '%s' is %u seconds old, max allowed is %u"),
+        'state': ('state', "      - Process '%s' is in state '%s'"),
+    }
+
+    # Growth rates of a process group, e.g. memgrowth: 100mb/h
+    growths = {
+        'memgrowth': ('memory', ' bytes'),
+        'fdgrowth': ('FDs', ''),
+        'conngrowth': ('connections', ''),
+    }
+
+    # Units for maxage and growth rates, in seconds
+    ages = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.rounding = 0
+        self.scale = 1
+        self.reset()
+        if name == 'maxmemory':
+            value = str(value).lower().strip()
+            if value.endswith('%'):
+                self.attr, self.limit, cvar = 'mempct', float(value[:-1]), '%%'
+            else:
+                self.attr, self.limit, cvar = 'mem', memory(value), ' bytes'
+            self.message = "      - Process '%%s' is using %%u%s memory, max allowed is %%u%s" % (cvar, cvar)
+            self.rounding = 0.5
+        elif name in self.growths:
+            # Kept in units per second, shown in units per what was asked.
+            what, cvar = self.growths[name]
+            amount, per = str(value).lower().replace(' ', '').split('/')
+            self.attr = name
+            self.scale = self.ages[per]
+            self.limit = float(memory(amount) if name == 'memgrowth' else int(amount)) / self.scale
+            unit = {'s': 'second', 'm': 'minute', 'h': 'hour', 'd': 'day'}[per]
+            self.message = "      - Process '%%s' is growing by %%d%s of %s per %s, max allowed is %%d%s" % (cvar, what, unit, cvar)
+            self.rounding = 0.5
+        elif name in self.kinds:
+            self.attr, self.message = self.kinds[name]
+            if name == 'state':
+                self.limit = value
+            elif name == 'maxage' and str(value)[-1:] in self.ages:
+                self.limit = int(str(value)[:-1]) * self.ages[str(value)[-1]]
+            else:
+                self.limit = int(value)
+        else:
+            raise ValueError("unknown trigger '%s'" % name)
+
+    def reset(self):
+        """Forgets what the last checks saw."""
+        self.peak = 0
+        self.worst = None
+        self.fired = False
+
+    def report(self):
+        """What the checks since the last reset saw: the threshold and the
+        worst value (in base units, growth rates per second), how close
+        that got as a share of the threshold, and whether it fired."""
+        return {
+            'threshold': self.limit,
+            'value': self.worst,
+            'share': round(self.peak, 3),
+            'fired': self.fired
+        }
 
+    def check(self, id, info):
+        """Returns what is wrong with info, if this trigger fires on it."""
+        print("    - Checking against trigger %s" % self.name)
+        current = getattr(info, self.attr, None)
+        if current is None:
+            print("      - Not enough history for '%s' yet" % id)
+            return None
+        if self.name == 'state':
+            lstr = self.message % (id, current)
+            fired = current == self.limit
+            if fired or self.worst is None:
+                self.worst = current
+        else:
+            lstr = self.message % (id, current * self.scale + self.rounding, self.limit * self.scale + self.rounding)
+            fired = current > self.limit
+            # How close the worst process got, as a share of the limit
+            if self.limit > 0:
+                self.peak = max(self.peak, float(current) / self.limit)
+            if self.worst is None or current > self.worst:
+                self.worst = current
+        print(lstr)
+        if fired:
+            self.fired = True
+            print("    - Trigger fired!")
+            return lstr
+        return None
+
+
+class Rule(object):
+    """A rule from kif.yaml, with its triggers compiled."""
+
+    def __init__(self, id, rule):
+        self.id = id
+        self.rule = rule
+        self.procid = rule.get('procid')
+        self.sustained = int(rule.get('sustained', 1))
+        # Growth triggers apply to the process group as a whole, the
+        # others to each process (or the group, with combine).
+        self.triggers = []
+        self.growth = []
+        for name, value in (rule.get('triggers') or {}).items():
+            try:
+                trigger = Trigger(name, value)
+            except (ValueError, KeyError) as err:
+                print("Rule %s: bad trigger %s: %s, ignoring it" % (id, name, err))
+                continue
+            if name in Trigger.growths:
+                self.growth.append(trigger)
+            else:
+                self.triggers.append(trigger)
+        # What the last scan found, for the sampler in between scans
+        self.pids = []
+        self.closeness = 0
+        self.seconds = 0
+        # Rules that need history are only checked by full scans.
+        self.quick = self.sustained == 1 and len(self.triggers) > 0
+
+
+class RuleSet(object):
+    """All the rules in kif.yaml, compiled once per change to the file.
+    procid strings are folded into a single regex, so every command line is
+    searched for all of them in one go: at each offset the regex picks the
+    longest procid found there, and `implies` adds the shorter procids that
+    are contained in it."""
+
+    def __init__(self, rules):
+        self.rules = [Rule(id, rule) for id, rule in rules.items()]
+        substrings = sorted(set(r.procid for r in self.rules if isinstance(r.procid, str)), key = len, reverse = True)
+        self.matcher = None
+        if substrings:
+            self.matcher = re.compile("(?=(%s))" % "|".join(re.escape(x) for x in substrings))
+        self.implies = dict((p, [q for q in substrings if q in p]) for p in substrings)
+
+    def index(self, snapshot):
+        """Finds the PIDs matching every procid string, in one pass over
+        the snapshot."""
+        found = dict((p, []) for p in self.implies)
+        if self.matcher:
+            for pid, info in snapshot.procs.items():
+                matched = set()
+                for m in self.matcher.finditer(info.cmdstr):
+                    matched.update(self.implies[m.group(1)])
+                for p in matched:
+                    found[p].append(pid)
+        snapshot.by_substring = found
+
+
+class History(object):
+    """The last `length` samples of each rule's process group (the totals
+    over all the processes it matched), in fixed-size ring buffers, from
+    which growth rates are worked out. Also counts how many runs in a row
+    each rule has fired. Everything is kept per rule rather than per PID,
+    so memory stays bounded however many processes come and go."""
+
+    fields = {'memgrowth': 1, 'fdgrowth': 2, 'conngrowth': 3}
+
+    def __init__(self, length = 12):
+        self.length = length
+        self.samples = {}
+        self.streaks = {}
+
+    def add(self, id, info):
+        """Records a sample of a group, and sets its growth rates."""
+        ring = self.samples.get(id)
+        if ring is None:
+            ring = self.samples[id] = collections.deque(maxlen = self.length)
+        ring.append((time.time(), info.mem, info.fds, info.conns))
+        for name, field in self.fields.items():
+            setattr(info, name, self.rate(ring, field))
+
+    def rate(self, ring, field):
+        """Growth per second of a field, as the least squares slope through
+        the samples, so that a single spike does not make a trend. None
+        until there are at least three samples."""
+        if len(ring) < 3:
+            return None
+        t0 = ring[0][0]
+        xs = [sample[0] - t0 for sample in ring]
+        ys = [sample[field] for sample in ring]
+        mx = sum(xs) / len(xs)
+        my = float(sum(ys)) / len(ys)
+        var = sum((x - mx) ** 2 for x in xs)
+        if not var:
+            return None
+        return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+
+    def streak(self, id, fired):
+        """Returns for how many runs in a row a rule has fired."""
+        self.streaks[id] = self.streaks.get(id, 0) + 1 if fired else 0
+        return self.streaks[id]
+
+    def resize(self, length):
+        """Changes how many samples are kept, carrying over the newest ones."""
+        if length != self.length:
+            self.length = length
+            for id, ring in self.samples.items():
+                self.samples[id] = collections.deque(ring, maxlen = length)
+
+    def forget(self, id):
+        self.samples.pop(id, None)
+        self.streaks.pop(id, None)
+
+    def prune(self, ids):
+        """Drops the history of rules that are gone."""
+        for id in set(self.samples) | set(self.streaks):
+            if id not in ids:
+                self.forget(id)
+
+HISTORY = History()
+
+
+def make_action(id, rule, trigger, pids):
+    action = {
+        'rule': id,
+        'pids': [],
+        'trigger': trigger,
+        'runlist': [],
+        'notify': rule.get('notify', None),
+        'kills': {}
+    }
+    if 'runlist' in rule and len(rule['runlist']) > 0:
+        action['runlist'] = rule['runlist']
+    if 'cooldown' in rule:
+        action['cooldown'] = float(rule['cooldown'])
+    if 'kill' in rule and rule['kill'] == True:
+        sig = 9
+        if 'killwith' in rule:
+            sig = int(rule['killwith'])
+        for pid in pids:
+            action['kills'][pid] = sig
+    return action
 
 
 def checkTriggers(id, info, triggers, dead = False):
     if len(triggers) > 0:
         print("  - Checking triggers:")
-    for trigger, value in triggers.items():
-        print("    - Checking against trigger %s" % trigger)
-
-        # maxmemory: Process can max use N amount of memory or it triggers
-        if trigger == 'maxmemory':
-            if value.find("%") != -1: # percentage check
-                maxmem = float(value.replace('%',''))
-                cmem = info.mempct
-                cvar = '%'
-            elif value.find('mb') != -1:    # mb check
-                maxmem = int(value.replace('mb','')) * MB
-                cmem = info.mem
-                cvar = ' bytes'
-            elif value.find('gb') != -1:    # gb check
-                maxmem = int(value.replace('gb','')) * GB
-                cmem = info.mem
-                cvar = ' bytes'
-            lstr = "      - Process '%s' is using %u%s memory, max allowed is %u%s" % (id, cmem+0.5, cvar, maxmem+0.5, cvar)
-            print(lstr)
-            if cmem > maxmem:
-                print("    - Trigger fired!")
-                return lstr
-
-        # maxfds: maximum number of file descriptors
-        if trigger == 'maxfds':
-            maxfds = int(value)
-            cfds = info.fds
-            lstr = "      - Process '%s' is using %u FDs, max allowed is %u" % (id, cfds, value)
-            print(lstr)
-            if cfds > maxfds:
-                print("    - Trigger fired!")
-                return lstr
-
-        # maxconns: maximum number of open connections
-        if trigger == 'maxconns':
-            maxconns = int(value)
-            ccons = info.conns
-            lstr = "      - Process '%s' is using %u connections, max allowed is %u" % (id, ccons, value)
-            print(lstr)
-            if ccons > maxconns:
-                print("    - Trigger fired!")
-                return lstr
-
-        # maxlocalconns: maximum number of open connections in local network
-        if trigger == 'maxlocalconns':
-            maxconns = int(value)
-            ccons = info.conns_local
-            lstr ="      - Process '%s' is using %u LAN connections, max allowed is %u" % (id, ccons, value)
-            print(lstr)
-            if ccons > maxconns:
-                print("    - Trigger fired!")
-                return lstr
-            
-        # maxage: maximum age of a process (NOT cpu time)
-        if trigger == 'maxage':
-            if value.find('s') != -1:    # seconds
-                maxage = int(value.replace('s',''))
-                cage = info.age
-                cvar = ' seconds'
-            elif value.find('m') != -1:    # minutes
-                maxage = int(value.replace('m','')) * 60
-                cage = info.age
-                cvar = ' minutes'
-            elif value.find('h') != -1:    # hours
-                maxage = int(value.replace('h','')) * 360
-                cage = info.age
-                cvar = ' hours'
-            elif value.find('d') != -1:    # days
-                maxage = int(value.replace('d','')) * 86400
-                cage = info.age
-                cvar = ' days'
-            else:
-                maxage = int(value)
-                cage = info.age
-            lstr ="      - Process '%s' is %u seconds old, max allowed is %u" % (id, cage,maxage)
-            print(lstr)
-            if cage > maxage:
-                print("    - Trigger fired!")
-                return lstr
-        
-        # state: kill processes in a specific state (zombie etc)
-        if trigger == 'state':
-            cstate = info.state
-            lstr ="      - Process '%s' is in state '%s'" % (id, cstate)
-            print(lstr)
-            if cstate == value:
-                print("    - Trigger fired!")
-                return lstr
+    for trigger in triggers:
+        lstr = trigger.check(id, info)
+        if lstr:
+            return lstr
     return None
 
-def scanForTriggers(config):
-    procs = getprocs() # get all current processes
+def scanForTriggers(rules, snapshot = None, only = None):
+    """Checks the rules against a snapshot of all processes (a new one if
+    not given) and returns the actions to take. With `only`, just those
+    rules are checked and only their plain triggers, against a quick
+    snapshot of the processes they matched (see quickScan); history is
+    left alone."""
+    if snapshot is None:
+        snapshot = Snapshot() # get all current processes
+    rules.index(snapshot)
     actions = []
 
     ### TODO: reindent
     if True:
 
         # For each rule..
-        for id, rule in config['rules'].items():
+        for compiled in (rules.rules if only is None else only):
+            id, rule = compiled.id, compiled.rule
+            started = time.time()
+            for trigger in compiled.triggers + (compiled.growth if only is None else []):
+                trigger.reset()
             print("- Running rule %s" % id)
             # Is this process running here?
             pids = []
             if 'procid' in rule:
                 procid = rule['procid']
                 print("  - Checking for process %s" % procid)
-                for xpid, cmdline in procs.items():
-                    addit = False
-                    if isinstance(procid, str):
-                        if " ".join(cmdline).find(rule['procid']) != -1:
-                            addit = True
-                    elif isinstance(procid, list):
-                        if cmdline == procid:
-                            addit = True
-                    if addit:
-                        if not ('ignore' in rule):
-                            addit = True
-                        elif isinstance(rule['ignore'], str) and " ".join(cmdline) != rule['ignore']:
-                            addit = True
-                        elif isinstance(rule['ignore'], list) and cmdline != rule['ignore']:
-                            addit = True
-                        if 'ignorepidfile' in rule:
-                            try:
-                                ppid = int(open(rule['ignorepidfile']).read())
-                                if ppid == xpid:
-                                    print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
-                                    addit = False
-                            except Exception as err:
-                                print(err)
-                        if addit:
-                            pids.append(xpid)
+                pids += snapshot.find(procid)
             if 'uid' in rule:
-                for xpid, cmdline in procs.items():
-                    uid = getuser(xpid)
-                    if uid == rule['uid']:
-                        addit = False
-                        if not ('ignore' in rule):
-                            addit = True
-                        elif isinstance(rule['ignore'], str) and " ".join(cmdline) != rule['ignore']:
-                            addit = True
-                        elif isinstance(rule['ignore'], list) and cmdline != rule['ignore']:
-                            addit = True
-                        if 'ignorepidfile' in rule:
-                            try:
-                                ppid = int(open(rule['ignorepidfile']).read())
-                                if ppid == xpid:
-                                    print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
-                                    addit = False
-                            except Exception as err:
-                                print(err)
-                        if addit:
-                            pids.append(xpid)
+                pids += snapshot.user(rule['uid'])
+            pids = [pid for pid in sorted(set(pids)) if not ignored(rule, snapshot.procs[pid])]
 
             # If proc is running, analyze it
             analysis = ProcessInfo()  # no pid. accumulator.
+            combine = 'combine' in rule and rule['combine'] == True
+            found = []
             for pid in pids:
                 print("  - Found process at PID %u" % pid)
 
                 try:
                     # Get all relevant data from this PID
-                    info = ProcessInfo(pid)
+                    info = snapshot.procs[pid]
+                    if info.error:
+                        raise info.error
     
-                    # If combining, combine into the analysis hash
-                    if 'combine' in rule and rule['combine'] == True:
-                        analysis.accumulate(info)
-                    else:
+                    # The group as a whole is always added up, for its history
+                    analysis.accumulate(info)
+                    if not combine:
                         # If running a per-pid test, run it:
-                        err = checkTriggers(id, info, rule['triggers'])
+                        err = checkTriggers(id, info, compiled.triggers)
                         if err:
-                            action = {
-                                'pids': [],
-                                'trigger': "",
-                                'runlist': [],
-                                'notify': rule.get('notify', None),
-                                'kills': {}
-                            }
-                            if 'runlist' in rule and len(rule['runlist']) > 0:
-                                action['runlist'] = rule['runlist']
-                            if 'kill' in rule and rule['kill'] == True:
-                                sig = 9
-                                if 'killwith' in rule:
-                                    sig = int(rule['killwith'])
-                                action['kills'][pid] = sig
-                            action['trigger'] = err
-                            actions.append(action)
+                            found.append(make_action(id, rule, err, [pid]))
                 except:
                     print("Could not analyze proc %u, bailing!" % pid)
                     continue
-            if len(pids) > 0:
-                # If combined trigger test, run it now
-                if 'combine' in rule and rule['combine'] == True:
-                    err = checkTriggers(id, analysis, rule['triggers'])
+            compiled.pids = pids
+            if only is not None:
+                if combine and len(pids) > 0:
+                    err = checkTriggers(id, analysis, compiled.triggers)
                     if err:
-                        action = {
-                            'pids': [],
-                            'trigger': "",
-                            'runlist': [],
-                            'notify': rule.get('notify', None),
-                            'kills': {}
-                        }
-                        if 'runlist' in rule and len(rule['runlist']) > 0:
-                            action['runlist'] = rule['runlist']
-                        if 'kill' in rule and rule['kill'] == True:
-                            sig = 9
-                            if 'killwith' in rule:
-                                sig = int(rule['killwith'])
-                            for ypid in pids:
-                                action['kills'][ypid] = sig
-                        action['trigger'] = err
-                        actions.append(action)
+                        found.append(make_action(id, rule, err, pids))
+                actions += found
+            elif len(pids) > 0:
+                HISTORY.add(id, analysis)
+                # If combined trigger test, run it now. Growth triggers
+                # always look at the group.
+                if combine:
+                    err = checkTriggers(id, analysis, compiled.triggers + compiled.growth)
+                else:
+                    err = checkTriggers(id, analysis, compiled.growth)
+                if err:
+                    found.append(make_action(id, rule, err, pids))
+                streak = HISTORY.streak(id, len(found) > 0)
+                if found and streak < compiled.sustained:
+                    print("  - Fired %u time(s) in a row, waiting for %u" % (streak, compiled.sustained))
+                else:
+                    actions += found
             else:
+                HISTORY.forget(id)
                 print("  - No matching processes found")
+            compiled.closeness = max([t.peak for t in compiled.triggers] or [0])
+            compiled.seconds = time.time() - started
                 
     return actions
 
@@ -347,26 +623,212 @@ parser.add_argument("-F", "--foreground", help="Run Kif continuous in foreground
 parser.add_argument("-s", "--stop", help="Stop the Kif daemon", action = 'store_true')
 parser.add_argument("-r", "--restart", help="Restart the Kif daemon", action = 'store_true')
 parser.add_argument("-c", "--config", help="Path to the config file if not in ./kif.yaml")
+parser.add_argument("-b", "--benchmark", help="Time rule evaluation over a synthetic table of N processes", type = int, metavar = 'N')
+parser.add_argument("-B", "--benchmark-connections", help="Time counting connections of 200 processes holding N sockets, in a synthetic /proc", type = int, metavar = 'N')
+parser.add_argument("-C", "--check-cooldown", help="Check that a rule stuck over its limit runs its runlist on every full scan, and is not mailed about in between", action = 'store_true')
 args = parser.parse_args()
 
-if not args.config:
-    CONFIG = yaml.load(open("kif.yaml"))
-else:
-    CONFIG = yaml.load(open(args.config))
+CONFIG_FILE = args.config or "kif.yaml"
+CONFIG_MTIME = None
+RULES = None
+
+def load_config():
+    """Loads kif.yaml and compiles its rules, unless it has not changed on
+    disk since the last time. If the new file is broken, the rules we have
+    are kept."""
+    global CONFIG, CONFIG_MTIME, RULES
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except OSError as err:
+        # The file may be briefly missing while it is being deployed
+        if CONFIG is None:
+            raise
+        print("Could not stat %s, keeping the rules we have: %s" % (CONFIG_FILE, err))
+        return CONFIG
+    if mtime != CONFIG_MTIME:
+        try:
+            config = yaml.load(open(CONFIG_FILE))
+            RULES = RuleSet(config.get('rules') or {})
+            CONFIG = config
+            HISTORY.resize(int(config.get('daemon', {}).get('history', HISTORY.length)))
+            HISTORY.prune([rule.id for rule in RULES.rules])
+        except Exception as err:
+            if CONFIG is None:
+                raise
+            print("Could not load %s, keeping the rules we have: %s" % (CONFIG_FILE, err))
+        CONFIG_MTIME = mtime
+    return CONFIG
+
+load_config()
+
+PAGESIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+STATES = {'R': 'running', 'S': 'sleeping', 'D': 'disk-sleep', 'Z': 'zombie', 'T': 'stopped',
+          't': 'tracing-stop', 'X': 'dead', 'I': 'idle', 'W': 'waking', 'P': 'parked'}
+
+def readProc(info):
+    """Returns a copy of info with its memory, fds, state and age read
+    straight from /proc/<pid>/stat and /proc/<pid>/fd: one read and one
+    directory listing, where psutil would take a dozen syscalls. Returns
+    None if the process is gone, or its PID now belongs to another one."""
+    try:
+        with open('/proc/%u/stat' % info.pid) as f:
+            stat = f.read()
+        fields = stat[stat.rfind(')') + 2:].split()
+        fds = len(os.listdir('/proc/%u/fd' % info.pid))
+    except (IOError, OSError):
+        return None
+    created = psutil.boot_time() + float(fields[19]) / CLK_TCK
+    if abs(created - getattr(info, 'created', created)) > 1:
+        return None
+    fresh = copy.copy(info)
+    fresh.mem = int(fields[21]) * PAGESIZE
+    fresh.mempct = 100.0 * fresh.mem / psutil.virtual_memory().total
+    fresh.fds = fds
+    fresh.state = STATES.get(fields[0], fields[0])
+    fresh.age = time.time() - created
+    return fresh
+
+
+def quickScan(rules, due):
+    """Re-checks the rules in `due` against fresh readings of just the
+    processes they matched last time, from /proc. Connection counts are
+    those of the last full scan."""
+    global QUIET
+    procs = []
+    for pid in set(pid for rule in due for pid in rule.pids):
+        fresh = readProc(rules.snapshot.procs[pid])
+        if fresh:
+            procs.append(fresh)
+    QUIET = True
+    try:
+        return scanForTriggers(rules, Snapshot(procs), due)
+    finally:
+        QUIET = False
+
+
+def runLoop():
+    """Runs kif until stopped: a full scan every daemon: interval seconds,
+    and in between a quick look (see quickScan) at the processes each rule
+    matched every daemon: sample seconds, or every daemon: fast seconds
+    while they are within daemon: near (a share of the limit) of one of
+    its triggers. With sample: 0, only full scans are done."""
+    next_scan = 0
+    next_sample = {}
+    while True:
+        config = load_config()
+        daemon = config.get('daemon', { })
+        now = time.time()
+        if now >= next_scan:
+            main(config, now)
+            next_scan = now + int(daemon.get('interval', DEFAULT_INTERVAL))
+            next_sample = {}
+        elif 'rules' in config:
+            due = [rule for rule in RULES.rules if rule.id in next_sample and next_sample[rule.id] <= now]
+            if due:
+                start = time.time()
+                actions = quickScan(RULES, due)
+                writeState(config, 'quick', 0, time.time() - start)
+                if actions:
+                    run_actions(config, actions, start)
+                for rule in due:
+                    del next_sample[rule.id]
+        wake = next_scan
+        sample = float(daemon.get('sample', DEFAULT_SAMPLE))
+        if sample > 0 and getattr(RULES, 'snapshot', None) and os.path.exists('/proc/self/stat'):
+            for rule in RULES.rules:
+                if rule.quick and rule.pids:
+                    if rule.id not in next_sample:
+                        near = rule.closeness >= float(daemon.get('near', 0.8))
+                        next_sample[rule.id] = time.time() + (float(daemon.get('fast', DEFAULT_FAST)) if near else sample)
+                    wake = min(wake, next_sample[rule.id])
+        time.sleep(max(0.1, wake - time.time()))
+
+
+def writeState(config, kind, snapshot_seconds, seconds):
+    """Writes what the last scan (of `kind` full or quick) found to
+    daemon: statefile as JSON: for each rule the PIDs it matched, its
+    triggers' thresholds against the worst values seen, and how long it
+    took to check; and how long the scan took in all. Rules a quick scan
+    did not look at are as the last scan that did left them."""
+    filename = config.get('daemon', { }).get('statefile', DEFAULT_STATEFILE)
+    if not filename:
+        return
+    state = {
+        'host': ME,
+        'time': time.time(),
+        'scan': kind,
+        'snapshot_seconds': snapshot_seconds,
+        'scan_seconds': seconds,
+        'processes': len(getattr(RULES, 'snapshot', None) and RULES.snapshot.procs or []),
+        'rules': {}
+    }
+    for rule in RULES.rules:
+        state['rules'][rule.id] = {
+            'pids': rule.pids,
+            'seconds': rule.seconds,
+            'closeness': rule.closeness,
+            'streak': HISTORY.streaks.get(rule.id, 0),
+            'triggers': dict((t.name, t.report()) for t in rule.triggers + rule.growth)
+        }
+    try:
+        with open(filename + ".tmp", "w") as f:
+            json.dump(state, f, indent = 1, sort_keys = True)
+        os.rename(filename + ".tmp", filename)
+    except (IOError, OSError) as err:
+        print("Could not write %s: %s" % (filename, err))
+
 
-def main(config):
+def main(config, start = None):
     if 'rules' not in config:
         print('- NO RULES TO CHECK')
     else:
         # Now actually run things
-        actions = scanForTriggers(config)
+        start = start or time.time()
+        RULES.snapshot = Snapshot()
+        snapped = time.time()
+        actions = scanForTriggers(RULES, RULES.snapshot)
+        writeState(config, 'full', snapped - start, time.time() - start)
         if actions:
-            run_actions(config, actions)
+            run_actions(config, actions, start)
 
     print('KIF run finished!')
 
 
-def run_actions(config, actions):
+def runCommand(item, timeout):
+    """Runs a runlist command through the shell, killing it (and anything
+    it started) if it takes more than `timeout` seconds. Returns whether it
+    succeeded, and what it said if it did not."""
+    proc = subprocess.Popen(item, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, preexec_fn = os.setsid)
+    expired = []
+    def expire():
+        expired.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        timer.cancel()
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    if expired:
+        return False, "timed out after %u seconds" % timeout
+    return proc.returncode == 0, output
+
+
+# When (the scan that) each rule last ran its runlist started, and when
+# the run a rule was last told it is cooling down from started
+LAST_RUN = {}
+SKIPPED = {}
+
+def run_actions(config, actions, start = None):
+        """Runs what a scan that began at `start` found should be done.
+        Cooldowns are measured between scan starts, so how long a scan
+        takes does not eat into the next one's turn."""
         ### TODO: reindent
 
         goods = 0
@@ -374,7 +836,42 @@ def run_actions(config, actions):
         triggered_total = 0
         email_triggers = ""
         email_actions = ""
+        daemon = config.get('daemon', { })
+        now = start or time.time()
+
+        # Work out every command to run in this cycle first. A command that
+        # several actions (or PIDs) asked for runs once, and rules still
+        # cooling down from their last run do not run theirs. That is only
+        # said once per run, and not mailed: a rule that stays over its
+        # limit is looked at every few seconds by the quick scans.
+        commands = []
+        for action in actions:
+            cooldown = action.get('cooldown', float(daemon.get('cooldown', DEFAULT_COOLDOWN)))
+            # (A rule that already ran at `now` did so in this very cycle.)
+            last = LAST_RUN.get(action['rule'])
+            if action['runlist'] and last and last != now and last > now - cooldown * 60:
+                if SKIPPED.get(action['rule']) != last:
+                    print("Rule %s ran its commands less than %g minutes ago, not running them again" % (action['rule'], cooldown))
+                    SKIPPED[action['rule']] = last
+                action['cooldown'] = cooldown
+                action['runlist'] = []
+            for item in action['runlist']:
+                if item not in commands:
+                    commands.append(item)
+            if action['runlist']:
+                LAST_RUN[action['rule']] = now
+
+        # ...then run them, a few at a time, each with a time limit.
+        results = {}
+        if commands and not args.debug:
+            timeout = float(daemon.get('timeout', DEFAULT_TIMEOUT))
+            pool = ThreadPool(min(len(commands), int(daemon.get('workers', DEFAULT_WORKERS))))
+            try:
+                results = dict(zip(commands, pool.map(lambda item: runCommand(item, timeout), commands)))
+            finally:
+                pool.close()
         
+        reported = set()
         for action in actions:
             triggered_total += 1
             print("Following triggers were detected:")
@@ -383,32 +880,29 @@ def run_actions(config, actions):
                 email_triggers += "- %s\n" % action['trigger']
             print("Running triggered commands:")
             rloutput = ""
+            if 'cooldown' in action and not action['runlist']:
+                rloutput += "- (runlist skipped, ran less than %g minutes ago)\n" % action['cooldown']
             for item in action['runlist']:
                 print("- %s" % item)
                 rloutput += "- %s" % item
-                if action.get('notify', 'email') in [None, 'email']:
-                    email_actions += "- %s" % item
-                try:
-                    if not args.debug:
-                        subprocess.check_output(item, shell = True, stderr=subprocess.STDOUT)
-                        rloutput += " (success)"
-                        if action.get('notify', 'email') in [None, 'email']:
-                            email_actions += " (success)"
-                    else:
-                        print("(disabled due to --debug flag)")
-                        rloutput += " (disabled due to --debug)"
-                        if action.get('notify', 'email') in [None, 'email']:
-                            email_actions += " (disabled due to --debug)"
+                if item in reported:
+                    # Ran once for all the actions that asked for it
+                    status = " (see above)"
+                elif args.debug:
+                    print("(disabled due to --debug flag)")
+                    status = " (disabled due to --debug)"
                     goods += 1
-                except subprocess.CalledProcessError as e:
-                    print("command failed: %s" % e.output)
-                    rloutput += " (failed!: %s)" % e.output
-                    if action.get('notify', 'email') in [None, 'email']:
-                        email_actions += " (failed!: %s)" % e.output
+                elif results[item][0]:
+                    status = " (success)"
+                    goods += 1
+                else:
+                    print("command failed: %s" % results[item][1])
+                    status = " (failed!: %s)" % results[item][1]
                     bads += 1
-                rloutput += "\n"
+                reported.add(item)
+                rloutput += status + "\n"
                 if action.get('notify', 'email') in [None, 'email']:
-                    email_actions += "\n"
+                    email_actions += "- %s%s\n" % (item, status)
             for pid, sig in action['kills'].items():
                 print("- KILL PID %u with sig %u" % (pid, sig))
                 rloutput += "- KILL PID %u with sig %u" % (pid, sig)
@@ -593,8 +1087,12 @@ except ImportError:
     # Python 3
     import builtins as __builtin__
 
+QUIET = False
+
 def print(*pargs, **pkwargs):
     global logging
+    if QUIET:
+        return
     if args.daemonize:
         __builtin__.print(*pargs)
         logging.info(*pargs, **pkwargs)
@@ -605,17 +1103,165 @@ if 'logging' in CONFIG and 'logfile' in CONFIG['logging']:
     logging.basicConfig(filename=CONFIG['logging']['logfile'], format='[%(asctime)s]: %(message)s', level=logging.INFO)
 
 
+def benchmark(nprocs):
+    """Times matching 40 rules against, and checking their triggers on, a
+    synthetic table of `nprocs` processes: the way kif used to (joining
+    each command line for each rule, parsing each threshold for each check)
+    and with the compiled rules."""
+    global QUIET
+    rules = {}
+    for i in range(40):
+        rule = {'triggers': {'maxmemory': '%umb' % (100 + i), 'maxfds': 1000, 'maxage': '%uh' % (1 + i % 24)}}
+        if i % 4 == 0:
+            rule['procid'] = ['/usr/bin/python', '/opt/app%u/worker.py' % i]
+        elif i % 4 == 1:
+            rule['uid'] = 'svc%u' % i
+        else:
+            rule['procid'] = '/usr/sbin/daemon%u' % i
+        rules['rule%u' % i] = rule
+    procs = []
+    for pid in range(1, nprocs + 1):
+        info = ProcessInfo()
+        info.pid = pid
+        info.error = None
+        info.username = 'svc%u' % (pid % 60)
+        info.mem = pid * MB
+        info.mempct = pid % 100
+        info.fds = pid % 2000
+        info.age = pid * 10
+        n = pid % 80
+        if pid % 3 == 0:
+            info.cmdline = ['/usr/bin/python', '/opt/app%u/worker.py' % n]
+        elif pid % 3 == 1:
+            info.cmdline = ['/usr/sbin/daemon%u' % n, '-f', '/etc/daemon%u.conf' % n, '--pidfile', '/var/run/daemon%u.pid' % n]
+        else:
+            info.cmdline = ['/usr/lib/jvm/java-8-openjdk-amd64/bin/java', '-Xmx4g', '-Dapp.id=%u' % pid, '-cp', '/opt/lib/*', 'org.example.Main']
+        procs.append(info)
+    snapshot = Snapshot(procs)
+    print("%u processes, %u rules" % (nprocs, len(rules)))
+
+    def before():
+        for id, rule in rules.items():
+            pids = []
+            for pid, info in snapshot.procs.items():
+                if isinstance(rule.get('procid'), str) and " ".join(info.cmdline).find(rule['procid']) != -1:
+                    pids.append(pid)
+                elif isinstance(rule.get('procid'), list) and info.cmdline == rule['procid']:
+                    pids.append(pid)
+                elif rule.get('uid') == info.username:
+                    pids.append(pid)
+            for pid in pids:
+                checkTriggers(id, snapshot.procs[pid], [Trigger(name, value) for name, value in rule['triggers'].items()])
+
+    def after():
+        scanForTriggers(RuleSet(rules), snapshot)
+
+    for name, func in [('before', before), ('after', after)]:
+        QUIET = True
+        start = time.time()
+        func()
+        spent = time.time() - start
+        QUIET = False
+        print("%-6s: %.1f ms" % (name, spent * 1000))
+
+
+def benchmarkConnections(nsockets, nprocs = 200):
+    """Builds a synthetic /proc with `nprocs` processes sharing `nsockets`
+    TCP sockets (a third of them to the LAN), and times counting their
+    connections with psutil, process by process, and with a
+    ConnectionIndex."""
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'net'))
+        shutil.copy('/proc/stat', os.path.join(root, 'stat'))
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open(os.path.join(root, 'net', 'tcp'), 'w') as f:
+            f.write("  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n")
+            for i in range(nsockets):
+                remote = struct.unpack('=I', socket.inet_aton("%s.%u.%u.%u" % (random.choice(['10', '62', '151']), i % 256, i // 256 % 256, 1 + i % 250)))[0]
+                f.write("%4u: 0100007F:1F90 %08X:%04X 01 00000000:00000000 00:00000000 00000000     0        0 %u 1 0000000000000000 20 4 30 10 -1\n" % (i, remote, 1024 + i % 60000, 100000 + i))
+        for table in ('tcp6', 'udp', 'udp6'):
+            with open(os.path.join(root, 'net', table), 'w') as f:
+                f.write("  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n")
+        for pid in range(1, nprocs + 1):
+            os.makedirs(os.path.join(root, str(pid), 'fd'))
+            with open(os.path.join(root, str(pid), 'stat'), 'w') as f:
+                f.write("%u%s" % (pid, stat[stat.find(' '):]))
+            for i in range(pid - 1, nsockets, nprocs):
+                os.symlink('socket:[%u]' % (100000 + i), os.path.join(root, str(pid), 'fd', str(i // nprocs + 3)))
+        print("%u processes, %u sockets" % (nprocs, nsockets))
+
+        def before():
+            psutil.PROCFS_PATH = root
+            try:
+                total = [0, 0]
+                for pid in range(1, nprocs + 1):
+                    connections = psutil.Process(pid).connections()
+                    total[0] += len(connections)
+                    for connection in connections:
+                        if connection.raddr and connection.raddr[0]:
+                            if RE_LOCAL_IP.match(connection.raddr[0]) or connection.raddr[0] == '::1':
+                                total[1] += 1
+                return total
+            finally:
+                psutil.PROCFS_PATH = '/proc'
+
+        def after():
+            index = ConnectionIndex(root)
+            total = [0, 0]
+            for pid in range(1, nprocs + 1):
+                fds, conns, conns_local = index.count(pid)
+                total[0] += conns
+                total[1] += conns_local
+            return total
+
+        for name, func in [('before', before), ('after', after)]:
+            start = time.time()
+            conns, conns_local = func()
+            spent = time.time() - start
+            print("%-6s: %.1f ms, %u connections, %u on the LAN" % (name, spent * 1000, conns, conns_local))
+    finally:
+        shutil.rmtree(root)
+
+
+def checkCooldown():
+    """Feeds run_actions what a rule stuck over its limit makes two full
+    scans, the default interval apart, and the quick scans in between
+    find, the way runLoop would. Fails unless its runlist ran on both full
+    scans, however long they took, and only they sent mail."""
+    global notifyEmail
+    config = {'notifications': {'email': {'rcpt': 'root@localhost', 'from': 'kif@localhost'}}}
+    sent = []
+    notifyEmail = lambda fro, to, subject, msg: sent.append(msg)
+    ran = []
+    start = time.time()
+    for offset in (0, 2, 4, 6, DEFAULT_INTERVAL, DEFAULT_INTERVAL + 2):
+        action = make_action('stuck', {'runlist': ['true']}, 'stuck over its limit', [])
+        run_actions(config, [action], start + offset)
+        if action['runlist']:
+            ran.append(offset)
+        # The scan itself (and so when run_actions is called) takes a while
+        time.sleep(0.01)
+    print("Runlist ran at %s, %u mails sent" % (ran, len(sent)))
+    if ran != [0, DEFAULT_INTERVAL] or len(sent) != 2:
+        print("FAIL: expected the runlist to run, and mail to be sent, at %s only" % [0, DEFAULT_INTERVAL])
+        sys.exit(1)
+
+
 ## Daemon class
 class MyDaemon(Daemonize):
     def run(self, args):
-        interval = int(CONFIG.get('daemon', { })
-                       .get('interval', DEFAULT_INTERVAL))
-        while True:
-            main(CONFIG)
-            time.sleep(interval)
+        runLoop()
 
 # Get started!
-if args.stop:
+if args.benchmark:
+    benchmark(args.benchmark)
+elif args.benchmark_connections:
+    benchmarkConnections(args.benchmark_connections)
+elif args.check_cooldown:
+    checkCooldown()
+elif args.stop:
     print("Stopping Kif")
     daemon = MyDaemon(PIDFILE)
     daemon.stop()
@@ -629,10 +1275,6 @@ else:
         daemon = MyDaemon(PIDFILE)
         daemon.start(args)
     elif args.foreground:
-        interval = int(CONFIG.get('daemon', { })
-                       .get('interval', DEFAULT_INTERVAL))
-        while True:
-            main(CONFIG)
-            time.sleep(interval)
+        runLoop()
     else:
         main(CONFIG)
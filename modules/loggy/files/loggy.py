@@ -26,20 +26,24 @@
 import os
 import select
 import sys
-import time, datetime
+import time, datetime, calendar
 import json
 import re
 import socket
-import hashlib, random
+import hashlib, random, struct, math
 from collections import defaultdict, namedtuple
 from threading import Thread
 import atexit, signal, inspect
-from threading import Lock
-import subprocess, collections, argparse, grp, pwd, shutil
+from threading import Lock, Event
+import subprocess, collections, argparse, grp, pwd, shutil, stat
 import ConfigParser
+import Queue
+import multiprocessing
 import platform
 import syslog
 import base64
+import BaseHTTPServer
+import gzip
 
 syslog.openlog('loggy', logoption=syslog.LOG_PID, facility=syslog.LOG_LOCAL0)
 
@@ -47,12 +51,15 @@ osname = platform.system().lower()
 if osname == "linux":
     from inotify import watcher
     import inotify
-elif osname == "freebsd":
-    from watchdog.observers import Observer
-    from watchdog.events import PatternMatchingEventHandler
     
 # ElasticSearch
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch
+
+# GeoIP lookups are optional
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
 
 config = ConfigParser.ConfigParser()
 dd_config = ConfigParser.ConfigParser()
@@ -90,6 +97,9 @@ except:
 
 inodes = {}
 inodes_path = {}
+# Every path we have followed, so we can tell a log recreated by a rotation
+# from any other new file
+followed = set()
 
 # The names must agree with the tuples below
 regexes = {
@@ -180,6 +190,64 @@ tuples = {
         )
 }
 
+# First characters a line can start with for each format. Formats mapped to
+# None can start with any non-blank character and are tried last.
+prefixes = {
+    'apache_access': '0123456789',
+    'apache_error': '[',
+    'syslog': None,
+    'fail2ban': None,
+    'rsync': None,
+    'pylogs': None,
+    'qmail': '@',
+    'lastlog': 'abcdefghijklmnopqrstuvwxyz0123456789'
+}
+
+json_regex = re.compile(r"<%JSON:([^>%]+)%>\s*(.+)")
+
+
+class LineClassifier:
+    """Dispatches a line to the log format it belongs to.
+
+    Candidate formats are looked up by the first byte of the line, and the
+    format that last matched a file is tried first, so a line from a file
+    with a single format normally costs one regex attempt."""
+
+    def __init__(self, regexes, prefixes):
+        self.regexes = regexes
+        self.last = {}
+        anychar = tuple(sorted(r for r in regexes if not prefixes.get(r)))
+        self.candidates = {}
+        for r in sorted(regexes):
+            for c in prefixes.get(r) or '':
+                self.candidates[c] = self.candidates.get(c, ()) + (r,)
+        for c in self.candidates:
+            self.candidates[c] += anychar
+        self.anychar = anychar
+
+    def classify(self, path, data, pos = 0, end = None):
+        """Returns (logtype, match) for the line in data[pos:end], or
+        (None, None). The line is matched in place, without slicing it out."""
+        if end is None:
+            end = len(data)
+        if pos >= end or data[pos].isspace():
+            return None, None
+        candidates = self.candidates.get(data[pos], self.anychar)
+        last = self.last.get(path)
+        if last in candidates:
+            match = self.regexes[last].match(data, pos, end)
+            if match:
+                return last, match
+        for r in candidates:
+            if r != last:
+                match = self.regexes[r].match(data, pos, end)
+                if match:
+                    self.last[path] = r
+                    return r, match
+        return None, None
+
+classifier = LineClassifier(regexes, prefixes)
+
 
 class Daemonize:
 	"""A generic daemon class.
@@ -304,115 +372,1682 @@ filehandles = {}
 json_pending = {}
 last_push = {}
 
-for t in tuples:
+for t in list(tuples) + ['loggy-indices', 'loggy-rollup']:
     json_pending[t] = []
     last_push[t] = time.time()
 
-gotindex = {}
+mappings_cache = None
+mappings_lock = Lock()
+checkpoints = None
+# Documents parsed in this process against each checkpoint mark that is
+# still open (see CheckpointStore)
+marked = {}
+geoip = None
+parsers = None
+rollup = None
+
+
+
+def index_mappings():
+    """Returns the per-logtype mappings built from [RawFields]. They are
+    worked out once and shared from then on."""
+    global mappings_cache
+    with mappings_lock:
+        if mappings_cache is None:
+            mappings = {}
+            for entry in config.options('RawFields'):
+                js = {
+                    "_all" : {"enabled" : True},
+                    "properties": {
+                        "@timestamp" : { "store": True, "type" : "date", "format": "yyyy/MM/dd HH:mm:ss"},
+                        "@node" : { "store": True, "type" : "string", "index": "not_analyzed"},
+                        "status" : { "store": True, "type" : "long"},
+                        "date" : { "store": True, "type" : "string", "index": "not_analyzed"},
+                        "geo_location" : { "type": "geo_point", "geohash": True },
+                        "geo_country" : { "store": True, "type": "string", "index": "not_analyzed"}
+                    }
+                }
+                for field in config.get('RawFields', entry).split(","):
+                    x = field.strip()
+                    js['properties'][x] = {"store": True, "type": "string", "index": "not_analyzed", "fields": { "keyword": { "type": "keyword" }}}
+                mappings[entry] = js
+            mappings_cache = mappings
+    return mappings_cache
+
+
+def register_template(xes):
+    """Registers an index template for loggy-*, so ES creates each day's
+    index with our settings and mappings on the first document sent to it,
+    without us checking for or creating indices ourselves."""
+    mappings = index_mappings()
+    res = xes.indices.put_template(name = 'loggy', body = {
+            "template": "loggy-*",
+            "settings" : {
+                "index.mapping.ignore_malformed": True,
+                "number_of_shards": 2,
+                "number_of_replicas": 0
+            },
+            "mappings" : mappings
+        }
+    )
+    json_pending['loggy-indices'].append({
+        '@node': hostname,
+        'template_registered': 'loggy-*',
+        'logtype': 'loggy-indices',
+        '@timestamp': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime()),
+        'res': res,
+        'mappings': mappings
+        })
+
+
+def build_actions(docs, logtype):
+    """Turns a list of pending documents into bulk index actions."""
+    random.seed(time.time())
+    #print("Pushing %u json objects" % len(json_pending))
+        
+    # Everything that is the same for the whole batch is worked out once.
+    header = {
+        '@version': 2,
+        'host': hostname,
+        '@node': hostname,
+        '@fingerprint': FINGERPRINT,
+        '@fingerprint_sha': FINGERPRINT_SHA
+    }
+    if mytags:
+        header['@tags'] = mytags
+    now = time.time()
+    shiptime = timestamps.format(now)
+    shipindex = index_name(now)
+
+    js_arr = []
+    for js in docs:
+        js.update(header)
+        # GeoHash conversion
+        if 'geo_lat' in js and 'geo_long' in js:
+            try:
+                js['geo_location'] = {
+                    "lat": float(js['geo_lat']),
+                    "lon": float(js['geo_long'])
+                }
+            except:
+                pass
+        if geoip:
+            geoip.enrich(js)
+        # Use the time the event happened if the line tells us, not when
+        # we got around to shipping it.
+        # The index follows the event time too, so late lines land in the
+        # index for the day they happened.
+        js['@timestamp'] = shiptime
+        iname = shipindex
+        if 'time' in js:
+            etime = apache_time(js['time'])
+            if etime is not None:
+                js['@timestamp'] = timestamps.format(etime)
+                iname = index_name(etime)
+        # Rogue string sometimes, we don't want that!
+        if 'bytes' in js:
+            try:
+                js['bytes'] = int(js['bytes'])
+            except:
+                js['bytes'] = 0
+        if 'status' in js:
+            try:
+                js['status'] = int(js['status'])
+            except:
+                pass
+        if 'request' in js and not 'url' in js:
+            match = request_regex.match(js['request'])
+            if match:
+                js['url'] = match.group(2)
+        
+        action = {
+            '_op_type': 'index',
+            '_index': iname,
+            '_type': logtype,
+            'doc': js,
+            '_source': js
+        }
+        # Documents that are updated by sending them again (rollups) bring
+        # their own id.
+        if '_id' in js:
+            action['_id'] = js.pop('_id')
+        js_arr.append(action)
+    return js_arr
+
+
+request_regex = re.compile(r"(GET|POST)\s+(.+)\s+HTTP/.+")
+
+months = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+last_apache_time = (None, None)
+
+def apache_time(text):
+    """Turns an apache timestamp (01/Jan/2017:00:00:00 +0000) into epoch
+    seconds, or None if it isn't one. Lines arrive in bursts sharing the
+    same second, so the last result is remembered."""
+    global last_apache_time
+    cached = last_apache_time
+    if cached[0] == text:
+        return cached[1]
+    try:
+        epoch = calendar.timegm((int(text[7:11]), months[text[3:6]], int(text[0:2]),
+                                 int(text[12:14]), int(text[15:17]), int(text[18:20])))
+        if len(text) >= 26:
+            offset = int(text[22:24]) * 3600 + int(text[24:26]) * 60
+            epoch -= offset if text[21] == '+' else -offset
+    except (ValueError, KeyError, IndexError):
+        epoch = None
+    last_apache_time = (text, epoch)
+    return epoch
+
+
+class TimestampCache:
+    """Formats epoch seconds as @timestamp values, remembering the last one
+    formatted since most documents in a batch share the same second."""
+
+    def __init__(self):
+        self.cached = (None, None)
+
+    def format(self, epoch):
+        second = int(epoch)
+        cached = self.cached
+        if cached[0] != second:
+            cached = (second, time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(second)))
+            self.cached = cached
+        return cached[1]
+
+timestamps = TimestampCache()
+
+last_index_name = (None, None)
+
+def index_name(epoch):
+    """Returns the name of the daily index an event at `epoch` belongs in."""
+    global last_index_name
+    day = int(epoch) // 86400
+    cached = last_index_name
+    if cached[0] != day:
+        cached = (day, time.strftime("loggy-%Y.%m.%d", time.gmtime(day * 86400)))
+        last_index_name = cached
+    return cached[1]
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of bulk request latencies (in seconds)."""
+
+    buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def add(self, seconds):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+
+    def percentile(self, pct):
+        """Returns the upper bound of the bucket the pct'th percentile
+        falls in, or None if nothing has been recorded."""
+        with self.lock:
+            counts = list(self.counts)
+        wanted = sum(counts) * pct / 100.0
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= wanted:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return None
+
+    def __str__(self):
+        with self.lock:
+            counts = list(self.counts)
+        out = []
+        for i, bound in enumerate(self.buckets):
+            out.append("<=%gs:%u" % (bound, counts[i]))
+        out.append(">%gs:%u" % (self.buckets[-1], counts[-1]))
+        return " ".join(out)
+
+
+class CheckpointStore:
+    """Remembers how far into each file we have read (by inode and offset),
+    so that a restarted loggy resumes where the last one stopped instead of
+    skipping to the end of the file. Updates are kept in memory and written
+    out, fsync'd, at most every `interval` seconds.
+
+    An offset is only saved once every line before it has been shipped or
+    spooled, so a loggy that is killed outright reads again what it had
+    not handed over yet rather than losing it. To that end, what is read
+    from a file is counted against a mark: open() starts one, and close()
+    ends it at the offset read up to. Documents carry their mark (as
+    `_mark`) until they are shipped, and each chunk handed to a parser
+    process holds its mark until the documents parsed from it are on their
+    way. Once a mark and all the marks of the file before it are closed
+    and nothing holds them any more, its offset is saved."""
+
+    def __init__(self, filename, interval = 5):
+        self.filename = filename
+        self.interval = interval
+        self.lock = Lock()
+        self.offsets = {}
+        self.dirty = False
+        self.last_sync = time.time()
+        # mark -> [path, inode, offset, held, closed], and the marks of each
+        # (path, inode), oldest first
+        self.marks = {}
+        self.queues = {}
+        self.next_mark = 0
+        try:
+            with open(filename, 'r') as f:
+                self.offsets = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, path, inode):
+        """Returns the saved offset for a file, or None if we have no
+        checkpoint for this particular inode."""
+        with self.lock:
+            entry = self.offsets.get(path)
+        if entry and entry[0] == inode:
+            return entry[1]
+        return None
+
+    def open(self, path, inode):
+        """Starts a new mark for a file, and returns it."""
+        with self.lock:
+            self.next_mark += 1
+            self.marks[self.next_mark] = [path, inode, None, 0, False]
+            self.queues.setdefault((path, inode), collections.deque()).append(self.next_mark)
+            return self.next_mark
+
+    def close(self, mark, offset, held = 0):
+        """Ends a mark at the offset read up to, held by the `held`
+        documents parsed against it in this process."""
+        with self.lock:
+            entry = self.marks[mark]
+            entry[2] = offset
+            entry[3] += held
+            entry[4] = True
+            self.settle(entry[0], entry[1])
+
+    def abandon(self, mark, held = 0):
+        """Ends a mark of a file that was let go of. Neither it nor any
+        earlier mark of that file will be saved."""
+        with self.lock:
+            entry = self.marks[mark]
+            for other in self.queues[(entry[0], entry[1])]:
+                self.marks[other][2] = None
+            entry[3] += held
+            entry[4] = True
+            self.settle(entry[0], entry[1])
+
+    def hold(self, counts):
+        """Holds marks, given as a dict of mark -> count."""
+        with self.lock:
+            for mark, n in counts.items():
+                self.marks[mark][3] += n
+
+    def release(self, counts):
+        """Lets go of marks held by hold(), or by documents, once they have
+        been shipped, spooled or dropped."""
+        with self.lock:
+            for mark, n in counts.items():
+                entry = self.marks[mark]
+                entry[3] -= n
+                self.settle(entry[0], entry[1])
+
+    def settle(self, path, inode):
+        """Saves the offset of the newest mark of a file that is done with,
+        along with all the marks before it. Called with the lock held."""
+        queue = self.queues[(path, inode)]
+        while queue:
+            entry = self.marks[queue[0]]
+            if not entry[4] or entry[3]:
+                break
+            del self.marks[queue.popleft()]
+            if entry[2] is not None:
+                self.offsets[path] = [inode, entry[2]]
+                self.dirty = True
+        if not queue:
+            del self.queues[(path, inode)]
+
+    def sync(self, force = False):
+        if not self.dirty or (not force and time.time() < self.last_sync + self.interval):
+            return
+        with self.lock:
+            data = json.dumps(self.offsets)
+            self.dirty = False
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpname, self.filename)
+        self.last_sync = time.time()
+
+
+def count_marks(docs, marks):
+    """Takes the checkpoint marks off documents about to be shipped (or
+    dropped), adding up how many there are of each in `marks`."""
+    for js in docs:
+        mark = js.pop('_mark', None)
+        if mark is not None:
+            marks[mark] = marks.get(mark, 0) + 1
+    return marks
+
+
+class Spool:
+    """A segmented, append-only on-disk queue of bulk actions that could not
+    be shipped. Each segment is a file of JSON lines; a segment is deleted
+    once everything in it has been shipped. Draining happens in a background
+    thread at no more than `rate` documents per second, so catching up after
+    an outage does not knock ES over again. How far into a segment draining
+    got is kept next to it, so a segment that is drained in several goes
+    is never shipped twice.
+
+    Documents ES refuses outright (a mapping conflict, say) would fail
+    however often they are retried, so they are set aside in rejected.json
+    instead, with the reason ES gave."""
+
+    def __init__(self, directory, segsize = 64 * 1024 * 1024, rate = 1000):
+        self.directory = directory
+        self.segsize = segsize
+        self.rate = rate
+        self.lock = Lock()
+        self.fd = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = self.segments()
+        self.seq = int(segments[-1].split(".")[0]) + 1 if segments else 0
+
+    def segments(self):
+        return sorted(f for f in os.listdir(self.directory) if f.endswith(".spool"))
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, "%012u.spool" % seq)
+
+    def append(self, actions):
+        with self.lock:
+            if not self.fd:
+                self.fd = open(self.segment_path(self.seq), 'a')
+            # One action_json() line each, so a document is not written out
+            # twice (as doc and _source)
+            for action in actions:
+                self.fd.write(action_json(action) + "\n")
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            if self.fd.tell() >= self.segsize:
+                self.roll()
+
+    def reject(self, rejected):
+        """Sets aside (action, reason) pairs for documents ES refused."""
+        with self.lock:
+            with open(os.path.join(self.directory, "rejected.json"), 'a') as f:
+                for action, reason in rejected:
+                    f.write('{"error": %s, "action": %s}\n' % (json.dumps(reason), action_json(action)))
+        syslog.syslog(syslog.LOG_WARNING, "Set aside %u documents ES rejected in %s" % (len(rejected), os.path.join(self.directory, "rejected.json")))
+
+    def roll(self):
+        """Closes the segment being written to, so it can be drained."""
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+            self.seq += 1
+
+    def next_segment(self):
+        """Returns the path of the oldest segment that is no longer being
+        written to, or None if there is nothing to drain."""
+        with self.lock:
+            segments = self.segments()
+            if self.fd:
+                if len(segments) > 1:
+                    segments = segments[:-1]
+                else:
+                    self.roll()
+        if segments:
+            return os.path.join(self.directory, segments[0])
+        return None
+
+    def drained(self, segment):
+        """Returns the number of lines of a segment already shipped."""
+        try:
+            with open(segment + ".done", 'r') as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+    def drain(self, sink):
+        while True:
+            segment = self.next_segment()
+            if not segment:
+                time.sleep(5)
+                continue
+            try:
+                done = self.drained(segment)
+                nlines = 0
+                js_arr = []
+                with open(segment, 'r') as f:
+                    for line in f:
+                        nlines += 1
+                        if nlines <= done:
+                            continue
+                        js_arr.append(json.loads(line))
+                        if len(js_arr) >= self.rate:
+                            self.ship(sink, js_arr)
+                            js_arr = []
+                            with open(segment + ".done", 'w') as d:
+                                d.write(str(nlines))
+                if js_arr:
+                    self.ship(sink, js_arr)
+                os.unlink(segment)
+                if os.path.exists(segment + ".done"):
+                    os.unlink(segment + ".done")
+                syslog.syslog(syslog.LOG_INFO, "Drained spool segment %s" % segment)
+            except Exception as err:
+                syslog.syslog(syslog.LOG_WARNING, "Could not drain spool segment %s: %s" % (segment, err))
+                time.sleep(30)
+
+    def ship(self, sink, js_arr):
+        start = time.time()
+        try:
+            sink.write(js_arr)
+        except ShipError as err:
+            # What ES took stays shipped. The rest goes to the back of the
+            # spool, or aside, rather than holding up everything behind it.
+            if err.failed:
+                self.append(err.failed)
+            if err.rejected:
+                self.reject(err.rejected)
+        spent = time.time() - start
+        if spent < 1:
+            time.sleep(1 - spent)
+
+    def start(self, sink):
+        t = Thread(target = self.drain, args = (sink,))
+        t.daemon = True
+        t.start()
+
+
+# Output sinks. A sink takes a batch of bulk actions in write(), and raises
+# if the batch could not be written; close() finishes off whatever the sink
+# has open, once nothing more will be written to it. Actions are either dicts (as made by
+# build_actions) or packed (index, type, JSON source) tuples, as sent back
+# by parser processes.
+
+class ShipError(Exception):
+    """Raised by a sink when only part of a batch could be written. `failed`
+    holds the actions worth trying again later, `rejected` (action, reason)
+    pairs for those that will never go in as they are."""
+
+    def __init__(self, failed, rejected):
+        Exception.__init__(self, "%u documents failed, %u were rejected" % (len(failed), len(rejected)))
+        self.failed = failed
+        self.rejected = rejected
+
+
+def pack_action(action):
+    """Packs a bulk action into an (index, type, JSON source) tuple, which
+    is far cheaper to pass between processes than the document itself.
+    Documents with an _id of their own get it as a fourth element."""
+    if '_id' in action:
+        return (action['_index'], action['_type'], json.dumps(action['_source']), action['_id'])
+    return (action['_index'], action['_type'], json.dumps(action['_source']))
 
 
+def action_json(action):
+    """Serializes a bulk action as a single line of JSON."""
+    if isinstance(action, dict):
+        action = pack_action(action)
+    docid = ', "_id": %s' % json.dumps(action[3]) if len(action) > 3 else ''
+    return '{"_index": %s, "_type": %s%s, "_source": %s}' % (json.dumps(action[0]), json.dumps(action[1]), docid, action[2])
 
-class NodeThread(Thread):
-    def assign(self, json, logtype, xes):
-        self.json = json
-        self.logtype = logtype
+
+class ElasticSearchSink:
+    """Ships batches to ElasticSearch through the bulk API. The index
+    template is registered once, up front; if ES cannot be reached at
+    startup, the next write tries again."""
+
+    def __init__(self, xes):
         self.xes = xes
+        self.lock = Lock()
+        self.templated = False
+        try:
+            self.bootstrap()
+        except Exception as err:
+            syslog.syslog(syslog.LOG_WARNING, "Could not register index template: %s" % err)
 
-    def run(self):
-        global gotindex, config, json_pending
-        random.seed(time.time())
-        #print("Pushing %u json objects" % len(json_pending))
-        iname = time.strftime("loggy-%Y.%m.%d")
-        sys.stderr.flush()
-        if not iname in gotindex:
-            gotindex[iname] = True
-            if not self.xes.indices.exists(index=iname):
-                mappings = {}
-                for entry in config.options('RawFields'):
-                    js = {
-                        "_all" : {"enabled" : True},
-                        "properties": {
-                            "@timestamp" : { "store": True, "type" : "date", "format": "yyyy/MM/dd HH:mm:ss"},
-                            "@node" : { "store": True, "type" : "string", "index": "not_analyzed"},
-                            "status" : { "store": True, "type" : "long"},
-                            "date" : { "store": True, "type" : "string", "index": "not_analyzed"},
-                            "geo_location" : { "type": "geo_point", "geohash": True }
-                        }
-                    }
-                    for field in config.get('RawFields', entry).split(","):
-                        x = field.strip()
-                        js['properties'][x] = {"store": True, "type": "string", "index": "not_analyzed", "fields": { "keyword": { "type": "keyword" }}}
-                    mappings[entry] = js
-                    
-                res = self.xes.indices.create(index = iname, ignore=400, body = {
-                        "settings" : {
-                            "index.mapping.ignore_malformed": True,
-                            "number_of_shards": 2,
-                            "number_of_replicas": 0
-                        },
-                        "mappings" : mappings
-                    }
-                )
-                if not 'loggy-indices' in json_pending:
-                    json_pending['loggy-indices'] = []
-                    last_push['loggy-indices'] = time.time()
-                json_pending['loggy-indices'].append({
-                    '@node': hostname,
-                    'index_created': iname,
-                    'logtype': 'loggy-indices',
-                    '@timestamp': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime()),
-                    'res': res,
-                    'mappings': mappings
-                    })
-            
-        js_arr = []
-        for entry in self.json:
-            js = entry
-            # GeoHash conversion
-            if 'geo_lat' in js and 'geo_long' in js:
-                try:
-                    js['geo_location'] = {
-                        "lat": float(js['geo_lat']),
-                        "lon": float(js['geo_long'])
-                    }
-                except:
-                    pass
-            js['@version'] = 2
-            js['@timestamp'] = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime())
-            js['host'] = hostname
-            js['@node'] = hostname
-            js['@fingerprint'] = FINGERPRINT
-            js['@fingerprint_sha'] = FINGERPRINT_SHA
-#             js['@rsa_key_mtime'] = RSA_KEY_MTIME
-            # Rogue string sometimes, we don't want that!
-            if 'bytes' in js:
+    def bootstrap(self):
+        with self.lock:
+            if not self.templated:
+                register_template(self.xes)
+                self.templated = True
+
+    def write(self, batch):
+        """Ships a batch in a single bulk request. If ES turns some of it
+        down, raises a ShipError telling those apart from the rest, as
+        they must not be sent again: items that were throttled or hit a
+        server error can be retried, anything else (such as a mapping
+        error) cannot."""
+        if not self.templated:
+            self.bootstrap()
+        packed = [pack_action(action) if isinstance(action, dict) else action for action in batch]
+        body = "".join('{"index": {"_index": %s, "_type": %s%s}}\n%s\n' % (
+                           json.dumps(action[0]), json.dumps(action[1]),
+                           ', "_id": %s' % json.dumps(action[3]) if len(action) > 3 else '', action[2])
+                       for action in packed)
+        res = self.xes.bulk(body = body)
+        if res.get('errors'):
+            failed = []
+            rejected = []
+            for action, item in zip(batch, res['items']):
+                result = list(item.values())[0]
+                status = result.get('status', 500)
+                if status == 429 or status >= 500:
+                    failed.append(action)
+                elif status >= 300:
+                    rejected.append((action, result.get('error')))
+            raise ShipError(failed, rejected)
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """Appends batches to gzip-compressed NDJSON files in a directory,
+    starting a new file once `rotate` bytes (uncompressed) have been written
+    to the current one. Each batch is flushed to the file as it is written,
+    but a file is only complete (and readable to the end by gunzip) once
+    it has been closed, by rotation or close()."""
+
+    def __init__(self, directory, rotate = 256 * 1024 * 1024):
+        self.directory = directory
+        self.rotate = rotate
+        self.lock = Lock()
+        self.fd = None
+        self.written = 0
+        self.seq = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, batch):
+        data = "".join(action_json(action) + "\n" for action in batch)
+        with self.lock:
+            if not self.fd:
+                self.seq += 1
+                filename = os.path.join(self.directory, "loggy-%s-%u-%u.ndjson.gz" % (time.strftime("%Y%m%d%H%M%S"), os.getpid(), self.seq))
+                self.fd = gzip.open(filename, 'ab', 6)
+                self.written = 0
+            self.fd.write(data)
+            self.fd.flush()
+            self.written += len(data)
+            if self.written >= self.rotate:
+                self.fd.close()
+                self.fd = None
+
+    def close(self):
+        with self.lock:
+            if self.fd:
+                self.fd.close()
+                self.fd = None
+
+
+class StreamSink:
+    """Writes each document as a line of JSON, to stdout or, if a host is
+    given, as one UDP datagram per document."""
+
+    def __init__(self, host = None, port = 0):
+        self.lock = Lock()
+        self.sock = None
+        if host:
+            self.addr = (host, port)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, batch):
+        if self.sock:
+            for action in batch:
+                self.sock.sendto(action_json(action), self.addr)
+        else:
+            data = "".join(action_json(action) + "\n" for action in batch)
+            with self.lock:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class ShipperPool:
+    """A fixed pool of threads shipping documents to the output sink.
+
+    Batches are handed over through a bounded queue, so at most `workers`
+    bulk requests are in flight at any time. When the sink falls behind and the
+    queue fills up, submit() blocks, which holds back the reader until
+    a slot frees up. Small batches waiting in the queue are merged into
+    a single bulk request of up to `maxdocs` documents. Documents that
+    could not be shipped go to the spool, if one is configured."""
+
+    def __init__(self, sink, workers = 4, queuesize = 32, maxdocs = 2000, spool = None):
+        self.sink = sink
+        self.spool = spool
+        self.queue = Queue.Queue(queuesize)
+        self.maxdocs = maxdocs
+        self.latency = LatencyHistogram()
+        self.threads = []
+        for i in range(workers):
+            t = Thread(target = self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, logtype, docs, marks = None):
+        """Queues a batch of documents, blocking while the queue is full.
+        A logtype of None means the batch is already made of bulk actions,
+        holding the checkpoint marks counted in `marks`."""
+        self.queue.put((logtype, docs, marks))
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        """Waits for everything queued to be shipped, then stops the workers
+        and closes the sink."""
+        self.queue.join()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.sink.close()
+
+    def work(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                self.queue.task_done()
+                return
+            batches = [batch]
+            ndocs = len(batches[0][1])
+            while ndocs < self.maxdocs:
                 try:
-                    js['bytes'] = int(js['bytes'])
-                except:
-                    js['bytes'] = 0
-            if mytags:
-                js['@tags'] = mytags
-            if 'request' in js and not 'url' in js:
-                match = re.match(r"(GET|POST)\s+(.+)\s+HTTP/.+", js['request'])
-                if match:
-                    js['url'] = match.group(2)
-            if 'bytes' in js and isinstance(js['bytes'], basestring) and js['bytes'].isdigit():
-                js['bytes_int'] = int(js['bytes'])
-            
-            js_arr.append({
-                '_op_type': 'index',
-                '_index': iname,
-                '_type': self.logtype,
-                'doc': js,
-                '_source': js
+                    batch = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                batches.append(batch)
+                ndocs += len(batch[1])
+            js_arr = []
+            marks = {}
+            try:
+                for logtype, docs, held in batches:
+                    if logtype is None:
+                        js_arr += docs
+                        for mark, n in (held or {}).items():
+                            marks[mark] = marks.get(mark, 0) + n
+                    else:
+                        count_marks(docs, marks)
+                        js_arr += build_actions(docs, logtype)
+                if len(js_arr) > 0:
+                    start = time.time()
+                    self.sink.write(js_arr)
+                    self.latency.add(time.time() - start)
+                    metrics.count_shipped(js_arr, True)
+                self.done(marks)
+            except ShipError as err:
+                # Only spool what did not go in, or it would be shipped twice.
+                syslog.syslog(syslog.LOG_WARNING, "Could not ship all of %u documents: %s" % (len(js_arr), err))
+                unshipped = err.failed + [action for action, reason in err.rejected]
+                gone = set(id(action) for action in unshipped)
+                metrics.count_shipped([action for action in js_arr if id(action) not in gone], True)
+                metrics.count_shipped(unshipped, False)
+                if self.save(err.failed, err.rejected):
+                    self.done(marks)
+            except Exception as err:
+                syslog.syslog(syslog.LOG_WARNING, "Could not ship %u documents: %s" % (ndocs, err))
+                metrics.count_shipped(js_arr, False)
+                if self.save(js_arr, []):
+                    self.done(marks)
+            for batch in batches:
+                self.queue.task_done()
+
+    def save(self, failed, rejected):
+        """Spools documents that can be shipped later, and sets aside those
+        ES rejected. Returns whether they are safely on disk."""
+        if not self.spool:
+            return False
+        try:
+            if failed:
+                self.spool.append(failed)
+            if rejected:
+                self.spool.reject(rejected)
+            return True
+        except Exception as err:
+            syslog.syslog(syslog.LOG_ERR, "Could not spool %u documents: %s" % (len(failed) + len(rejected), err))
+            return False
+
+    def done(self, marks):
+        """Lets go of the checkpoint marks of a batch that was shipped or
+        spooled. If it was neither, they are kept, so the checkpoints of
+        its files stay put and a restart reads those lines again."""
+        if checkpoints and marks:
+            checkpoints.release(marks)
+
+    def report(self):
+        syslog.syslog(syslog.LOG_INFO, "Shipper queue depth: %u/%u, bulk latency: %s" % (self.depth(), self.queue.maxsize, self.latency))
+
+
+class Metrics:
+    """Counters describing what loggy is up to. They are served as text on
+    /metrics by a MetricsServer and can be shipped as loggy-metrics
+    documents. Parser processes count into their own copy and hand what they
+    counted back with each batch (see take() and merge())."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.shipper = None
+        self.reset()
+
+    def reset(self):
+        self.lines_read = 0
+        self.lines_matched = defaultdict(int)
+        self.docs_shipped = defaultdict(int)
+        self.docs_failed = defaultdict(int)
+
+    def count_lines(self, nlines, matched):
+        with self.lock:
+            self.lines_read += nlines
+            for logtype, count in matched.items():
+                self.lines_matched[logtype] += count
+
+    def count_shipped(self, js_arr, ok):
+        counts = defaultdict(int)
+        for action in js_arr:
+            counts[action['_type'] if isinstance(action, dict) else action[1]] += 1
+        with self.lock:
+            target = self.docs_shipped if ok else self.docs_failed
+            for logtype, count in counts.items():
+                target[logtype] += count
+
+    def take(self):
+        """Returns the line counters and zeroes them."""
+        with self.lock:
+            counts = (self.lines_read, dict(self.lines_matched))
+            self.lines_read = 0
+            self.lines_matched = defaultdict(int)
+        return counts
+
+    def merge(self, counts):
+        self.count_lines(*counts)
+
+    def snapshot(self):
+        with self.lock:
+            snap = {
+                'lines_read': self.lines_read,
+                'lines_unmatched': self.lines_read - sum(self.lines_matched.values()),
+                'lines_matched': dict(self.lines_matched),
+                'docs_shipped': dict(self.docs_shipped),
+                'docs_failed': dict(self.docs_failed)
+            }
+        snap['pending_docs'] = dict((x, len(json_pending[x])) for x in list(json_pending))
+        snap['bytes_read'] = {}
+        snap['tail_lag'] = {}
+        for path, tailer in list(filehandles.items()):
+            try:
+                snap['bytes_read'][path] = tailer.bytes_read
+                snap['tail_lag'][path] = tailer.lag()
+            except (OSError, ValueError):
+                pass
+        if self.shipper:
+            snap['queue_depth'] = self.shipper.depth()
+            snap['bulk_latency'] = {}
+            for pct in (50, 90, 99):
+                snap['bulk_latency']['p%u' % pct] = self.shipper.latency.percentile(pct)
+        return snap
+
+    def render(self):
+        """Renders a snapshot in the Prometheus text format."""
+        out = []
+        for key, value in sorted(self.snapshot().items()):
+            label = 'path' if key in ('bytes_read', 'tail_lag') else 'logtype'
+            if key == 'bulk_latency':
+                label = 'percentile'
+            if isinstance(value, dict):
+                for name, v in sorted(value.items()):
+                    if v is not None:
+                        out.append('loggy_%s{%s="%s"} %s' % (key, label, name, '+Inf' if v == float('inf') else v))
+            else:
+                out.append('loggy_%s %s' % (key, value))
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics(shipper):
+    """Starts the /metrics endpoint if [Metrics] port is set."""
+    metrics.shipper = shipper
+    port = config_option('Metrics', 'port', 0)
+    if port:
+        server = BaseHTTPServer.HTTPServer((config_option('Metrics', 'bind', '127.0.0.1'), port), MetricsHandler)
+        t = Thread(target = server.serve_forever)
+        t.daemon = True
+        t.start()
+        syslog.syslog(syslog.LOG_INFO, "Serving metrics on port %u" % port)
+
+
+def emit_metrics():
+    """Queues loggy-metrics documents if [Metrics] emit is set and it is
+    time for them: one with the overall counters, and one per file we
+    follow, naming it in `path`. File names can't be field names, as ES
+    takes the dots in them for object paths. Only call this from the
+    thread flushing json_pending."""
+    global last_emit
+    interval = config_option('Metrics', 'emit', 0)
+    if interval and time.time() > last_emit + interval:
+        if not 'loggy-metrics' in json_pending:
+            json_pending['loggy-metrics'] = []
+            last_push['loggy-metrics'] = time.time()
+        snap = metrics.snapshot()
+        bytes_read = snap.pop('bytes_read')
+        tail_lag = snap.pop('tail_lag')
+        # A percentile past the last bucket is infinite, which JSON can't say.
+        for pct, value in list(snap.get('bulk_latency', {}).items()):
+            if value is None or value == float('inf'):
+                del snap['bulk_latency'][pct]
+        docs = [snap]
+        for path in sorted(bytes_read):
+            docs.append({
+                'path': path,
+                'bytes_read': bytes_read[path],
+                'tail_lag': tail_lag[path]
             })
-            
-        if len(js_arr) > 0:
-            #es.bulk(index=iname, doc_type=self.logtype, body = js_arr )
-            helpers.bulk(self.xes, js_arr)
-        #except Exception as err:
-            #print(err)
-            
+        for doc in docs:
+            doc['@node'] = hostname
+            doc['logtype'] = 'loggy-metrics'
+        json_pending['loggy-metrics'] += docs
+        last_emit = time.time()
+
+last_emit = time.time()
+
+
+def config_option(section, key, default):
+    """Returns a config option, cast to the type of its default value."""
+    if config.has_option(section, key):
+        return type(default)(config.get(section, key))
+    return default
+
+
+def connect_sink(config):
+    """Sets up the output sink named in [Output], ElasticSearch by default."""
+    kind = config_option('Output', 'sink', 'elasticsearch')
+    if kind == 'file':
+        sink = FileSink(
+            config_option('Output', 'path', '/var/spool/loggy/out'),
+            rotate = config_option('Output', 'rotate', 256) * 1024 * 1024
+        )
+        # Don't leave a truncated gzip file behind if we exit without
+        # stopping the shipper first.
+        atexit.register(sink.close)
+        return sink
+    if kind == 'stdout':
+        return StreamSink()
+    if kind == 'udp':
+        return StreamSink(config_option('Output', 'host', 'localhost'), config_option('Output', 'port', 5140))
+    return ElasticSearchSink(connect_es(config))
+
+
+def start_shipper(sink):
+    global checkpoints
+    spool = None
+    if config.has_section('Spool'):
+        spool = Spool(
+            config_option('Spool', 'path', '/var/spool/loggy'),
+            segsize = config_option('Spool', 'segment', 64) * 1024 * 1024,
+            rate = config_option('Spool', 'rate', 1000)
+        )
+        spool.start(sink)
+        checkpoints = CheckpointStore(
+            config_option('Spool', 'checkpoints', '/var/spool/loggy/checkpoints.json'),
+            interval = config_option('Spool', 'sync', 5)
+        )
+    return ShipperPool(
+        sink,
+        workers = config_option('Shipper', 'workers', 4),
+        queuesize = config_option('Shipper', 'queue', 32),
+        maxdocs = config_option('Shipper', 'batch', 2000),
+        spool = spool
+    )
+
+
+def open_tail(path, inode, fresh = False):
+    """Opens a file for tailing, resuming from its checkpoint if we have one
+    for this inode. Otherwise, a file we just saw being created under a
+    path we followed before (the new log after a rotation) is read from
+    the start, and any other file, such as a copytruncate copy or a log
+    copied in from elsewhere, from its end."""
+    fresh = fresh and path in followed
+    followed.add(path)
+    fh = open(path, "r")
+    offset = checkpoints.get(path, inode) if checkpoints else None
+    if offset is not None and offset <= os.fstat(fh.fileno()).st_size:
+        print("Resuming %s from offset %u" % (path, offset))
+        fh.seek(offset)
+    elif not fresh:
+        fh.seek(0,2)
+    tailer = Tailer(path, fh, parsers.submit if parsers else None)
+    if checkpoints:
+        tailer.mark = checkpoints.open(path, inode)
+    return tailer
+
+
+class Sampler:
+    """Decides which lines of a log type to keep when it floods us. Lines are
+    first sampled at a fixed `rate`, then limited to `cap` per second by a
+    token bucket. With keep_errors, lines whose status is not 2xx are always
+    kept. keep() returns 0 to drop a line, and stamp() records the sample
+    rate on a kept document, so aggregations can weigh it back up.
+
+    The share of lines the cap lets through is only known in hindsight, so
+    documents kept by the cap are held until settle() stamps them with the
+    fixed rate times the share of lines let through since the last settle.
+    take_pending() settles before documents leave json_pending, so the
+    rates add back up to the lines offered, even at the onset of a burst.
+
+    Sampling happens before a line is even turned into a document, so a
+    burst cannot grow json_pending past `cap` documents per second. With
+    parser processes, each worker applies its own cap."""
+
+    def __init__(self, logtype, rate = 1.0, cap = 0, keep_errors = False):
+        self.rate = rate
+        self.cap = cap
+        self.keep_errors = keep_errors
+        self.has_status = logtype in regexes and 'status' in regexes[logtype].groupindex
+        self.tokens = cap
+        self.last = time.time()
+        self.offered = 0
+        self.kept = 0
+        self.held = []
+        self.exempt = False
+
+    def keep(self, status):
+        self.exempt = bool(self.keep_errors and status and status[0] != '2')
+        if self.exempt:
+            return 1.0
+        if self.rate < 1 and random.random() >= self.rate:
+            return 0
+        if not self.cap:
+            return self.rate
+        now = time.time()
+        self.offered += 1
+        self.tokens = min(self.cap, self.tokens + (now - self.last) * self.cap)
+        self.last = now
+        if self.tokens < 1:
+            return 0
+        self.tokens -= 1
+        self.kept += 1
+        return self.rate
+
+    def stamp(self, js, rate):
+        """Records the sample rate on the document keep() just let through,
+        holding it for settle() if the cap had a say in it."""
+        js['sample_rate'] = rate
+        if self.cap and not self.exempt:
+            self.held.append(js)
+
+    def settle(self):
+        """Stamps the held documents with the share of lines the cap let
+        through since the last settle. Lines dropped after the last held
+        document count towards the next ones."""
+        if self.held:
+            ratio = float(self.kept) / self.offered
+            for js in self.held:
+                js['sample_rate'] = self.rate * ratio
+            self.held = []
+            self.kept = 0
+            self.offered = 0
+
+
+samplers = {}
+
+def start_samplers():
+    """Sets up a Sampler for each log type listed in [Sampling], e.g.
+    apache_access: rate=0.5, cap=2000, keep_errors=yes"""
+    if config.has_section('Sampling'):
+        for logtype in config.options('Sampling'):
+            opts = {}
+            for opt in config.get('Sampling', logtype).split(","):
+                if "=" in opt:
+                    key, value = opt.split("=", 1)
+                    opts[key.strip()] = value.strip()
+            samplers[logtype] = Sampler(
+                logtype,
+                rate = float(opts.get('rate', 1.0)),
+                cap = int(opts.get('cap', 0)),
+                keep_errors = opts.get('keep_errors', 'no') in ('yes', 'true')
+            )
+            syslog.syslog(syslog.LOG_INFO, "Sampling %s: %s" % (logtype, config.get('Sampling', logtype)))
+
+
+def take_pending(x):
+    """Takes the documents pending for a log type, passing them through the
+    rollup stage on the way."""
+    if x in samplers:
+        samplers[x].settle()
+    docs = json_pending[x]
+    json_pending[x] = []
+    if rollup and x == 'apache_access' and docs:
+        rollup.add(docs)
+        if rollup.mode == 'instead':
+            if checkpoints:
+                checkpoints.release(count_marks(docs, {}))
+            return []
+    return docs
+
+
+first_push = {}
+
+def flush_pending(shipper, force = False):
+    """Hands each log type that has 500 documents waiting, or has not been
+    pushed for [Analyzer] flush seconds, to the shipper. With force, flushes
+    everything."""
+    if rollup:
+        rollup.flush(force)
+    interval = config_option('Analyzer', 'flush', 15.0)
+    for x in list(json_pending):
+        if force or (time.time() > (last_push.get(x, 0) + interval)) or len(json_pending[x]) >= 500:
+            if not x in first_push and json_pending[x]:
+                first_push[x] = True
+                syslog.syslog(syslog.LOG_INFO, "First push for " + x + "!")
+            docs = take_pending(x)
+            if docs:
+                shipper.submit(x, docs)
+            last_push[x] = time.time()
+
+
+class HyperLogLog:
+    """Estimates the number of distinct values added to it, using 2^p one-byte
+    registers. Values are hashed with MD5, so the registers of sketches from
+    different hosts or minutes can be merged (by taking the maximum of each
+    register) to count uniques over a whole day."""
+
+    def __init__(self, p = 10):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+        j = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(estimate + 0.5)
+
+    def encode(self):
+        return base64.b64encode(bytes(self.registers))
+
+
+class SpaceSaving:
+    """Approximate top-k counter (the space-saving algorithm): keeps at most
+    `capacity` values, and a new value evicts the least counted one,
+    inheriting its count."""
+
+    def __init__(self, capacity = 100):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value):
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < self.capacity:
+            counts[value] = 1
+        else:
+            victim = min(counts, key = counts.get)
+            counts[value] = counts.pop(victim) + 1
+
+    def top(self, k):
+        return sorted(self.counts.items(), key = lambda c: -c[1])[:k]
+
+
+class Rollup:
+    """Aggregates apache_access lines into one document per vhost per minute:
+    hits, bytes, hits per status class, an estimate (plus mergeable sketch)
+    of unique client IPs, and the top URIs and referrers. A minute is shipped
+    as a loggy-rollup document once `grace` seconds have passed since it
+    ended. Its bucket is kept until no line has been added to it for
+    another `grace` seconds, so the buckets held in memory stay bounded.
+
+    Lines that turn up late (or are backfilled) are added to the bucket
+    for their minute, which is then shipped again in full. The document
+    always has the same _id (node, vhost, minute and, with parser
+    processes, the worker), so ES keeps one document per minute with the
+    latest totals.
+
+    With mode 'alongside' the raw lines are shipped as well, with 'instead'
+    only the rollups are."""
+
+    def __init__(self, mode, topk = 20, grace = 120):
+        self.mode = mode
+        self.topk = topk
+        self.grace = grace
+        self.buckets = {}
+        self.shard = ''
+
+    def add(self, docs):
+        now = time.time()
+        for js in docs:
+            etime = apache_time(js.get('time', ''))
+            minute = int(etime if etime is not None else js['timestamp']) // 60 * 60
+            vhost = js.get('vhost') or os.path.basename(js.get('filepath', ''))
+            bucket = self.buckets.get((vhost, minute))
+            if not bucket:
+                bucket = {
+                    'hits': 0,
+                    'bytes': 0,
+                    'status_classes': defaultdict(int),
+                    'ips': HyperLogLog(),
+                    'uris': SpaceSaving(self.topk * 5),
+                    'referers': SpaceSaving(self.topk * 5)
+                }
+                self.buckets[(vhost, minute)] = bucket
+            bucket['hits'] += 1
+            bucket['touched'] = now
+            bucket['dirty'] = True
+            try:
+                bucket['bytes'] += int(js.get('bytes', 0))
+            except ValueError:
+                pass
+            bucket['status_classes'][str(js.get('status', '0'))[:1] + "xx"] += 1
+            if js.get('client_ip'):
+                bucket['ips'].add(js['client_ip'])
+            match = request_regex.match(js.get('request', ''))
+            if match:
+                bucket['uris'].add(match.group(2))
+            if js.get('referer', '-') != '-':
+                bucket['referers'].add(js['referer'])
+
+    def flush(self, force = False):
+        """Queues rollup documents for every minute that is over and got
+        lines since it was last queued, and forgets minutes that have been
+        quiet for long enough."""
+        cutoff = time.time() - self.grace
+        for key in list(self.buckets):
+            vhost, minute = key
+            bucket = self.buckets[key]
+            if not bucket['dirty']:
+                if bucket['touched'] < cutoff:
+                    del self.buckets[key]
+                continue
+            if force or minute + 60 < cutoff:
+                bucket['dirty'] = False
+                json_pending['loggy-rollup'].append({
+                    '_id': "%s:%s:%u%s" % (hostname, vhost, minute, self.shard),
+                    'logtype': 'loggy-rollup',
+                    'vhost': vhost,
+                    'time': time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(minute)),
+                    'timestamp': time.time(),
+                    'hits': bucket['hits'],
+                    'bytes': bucket['bytes'],
+                    'status_classes': dict(bucket['status_classes']),
+                    'unique_ips': bucket['ips'].count(),
+                    'ips_sketch': bucket['ips'].encode(),
+                    'top_uris': [{'uri': u, 'hits': n} for u, n in bucket['uris'].top(self.topk)],
+                    'top_referers': [{'referer': r, 'hits': n} for r, n in bucket['referers'].top(self.topk)]
+                })
+
+
+class GeoIP:
+    """Looks up where client IPs are in a local MaxMind (GeoLite2/GeoIP2
+    City or Country) database. The file is memory-mapped rather than read
+    in, so it costs no heap and is shared with the page cache (and between
+    parser processes). Client IPs repeat a lot, so the answers for the last
+    `cachesize` of them are kept in an LRU cache. Documents are enriched by
+    the shipper threads, so the cache is guarded by a lock."""
+
+    def __init__(self, filename, cachesize = 10000):
+        self.reader = maxminddb.open_database(filename, maxminddb.MODE_MMAP)
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, ip):
+        """Returns (country code, geo_point) for an IP, either of which may
+        be None, or None if the IP is not in the database."""
+        with self.lock:
+            if ip in self.cache:
+                found = self.cache.pop(ip)
+                self.cache[ip] = found
+                self.hits += 1
+                return found
+            self.misses += 1
+        # The database is read-only, so look it up without holding the lock
+        found = self.find(ip)
+        with self.lock:
+            self.cache.pop(ip, None)
+            if self.cache and len(self.cache) >= self.cachesize:
+                self.cache.popitem(last = False)
+            self.cache[ip] = found
+        return found
+
+    def find(self, ip):
+        try:
+            record = self.reader.get(ip)
+        except ValueError:
+            return None
+        if not record:
+            return None
+        country = (record.get('country') or record.get('registered_country') or {}).get('iso_code')
+        location = record.get('location')
+        if location and 'latitude' in location and 'longitude' in location:
+            location = {"lat": location['latitude'], "lon": location['longitude']}
+        else:
+            location = None
+        return (country, location)
+
+    def enrich(self, js):
+        """Fills in geo_country and geo_location from client_ip, unless the
+        line already told us."""
+        if 'client_ip' in js and not 'geo_country' in js:
+            found = self.lookup(js['client_ip'])
+            if found:
+                if found[0]:
+                    js['geo_country'] = found[0]
+                if found[1] and not 'geo_location' in js:
+                    js['geo_location'] = found[1]
+
+
+def start_geoip():
+    global geoip
+    filename = config_option('GeoIP', 'database', '')
+    if filename:
+        if not maxminddb:
+            syslog.syslog(syslog.LOG_WARNING, "GeoIP database configured, but the maxminddb module is not installed")
+        else:
+            try:
+                geoip = GeoIP(filename, config_option('GeoIP', 'cache', 10000))
+                syslog.syslog(syslog.LOG_INFO, "Looking up client IPs in " + filename)
+            except (IOError, ValueError) as err:
+                syslog.syslog(syslog.LOG_WARNING, "Could not open GeoIP database %s: %s" % (filename, err))
+    return geoip
+
+
+def start_rollup():
+    global rollup
+    mode = config_option('Rollup', 'mode', 'off')
+    if mode in ('alongside', 'instead'):
+        rollup = Rollup(mode, topk = config_option('Rollup', 'topk', 20))
+    return rollup
+
+
+def parser_worker(inbox, outbox, maxdocs, interval, shard = 0):
+    """Main loop of a parser process (see ParserPool)."""
+    if rollup:
+        # Another worker may see the same vhost, in a file of its own.
+        rollup.shard = ":%u" % shard
+    last_flush = time.time()
+    chunks = {}
+    while True:
+        try:
+            item = inbox.get(timeout = min(1, interval))
+        except Queue.Empty:
+            item = False
+        if item:
+            parseLine(*item)
+            if item[4] is not None:
+                chunks[item[4]] = chunks.get(item[4], 0) + 1
+        if rollup:
+            rollup.flush(item is None)
+        pending = sum(len(json_pending[x]) for x in json_pending)
+        if (pending or chunks) and (item is None or pending >= maxdocs or time.time() > last_flush + interval):
+            js_arr = []
+            marks = {}
+            for x in json_pending:
+                docs = take_pending(x)
+                if docs:
+                    count_marks(docs, marks)
+                    js_arr += [pack_action(a) for a in build_actions(docs, x)]
+            # Everything parsed from the chunks counted so far is in this
+            # batch or an earlier one, so they can let go of their marks.
+            outbox.put((js_arr, metrics.take(), marks, chunks))
+            chunks = {}
+            marked.clear()
+            last_flush = time.time()
+        if item is None:
+            return
+
+
+class ParserPool:
+    """Parses log data in a pool of worker processes, so that parsing is not
+    held to a single core by the GIL. Each file is always handed to the same
+    worker, which keeps its lines in order. Workers turn what they parse into
+    ready-to-ship bulk actions and send them back in batches of up to
+    `maxdocs` documents (or whatever they have every `interval` seconds),
+    which are passed on to the shipper, along with the checkpoint marks
+    of the chunks they were parsed from.
+
+    The pool must be created before any other threads are started, as the
+    workers are forked off the current process."""
+
+    def __init__(self, workers = 4, maxdocs = 500, interval = 15):
+        self.inputs = []
+        self.procs = []
+        self.results = multiprocessing.Queue()
+        self.collector = None
+        for i in range(workers):
+            inbox = multiprocessing.Queue(64)
+            proc = multiprocessing.Process(target = parser_worker, args = (inbox, self.results, maxdocs, interval, i))
+            proc.daemon = True
+            proc.start()
+            self.inputs.append(inbox)
+            self.procs.append(proc)
+
+    def start(self, shipper):
+        """Starts passing parsed batches on to the shipper."""
+        self.collector = Thread(target = self.collect, args = (shipper,))
+        self.collector.daemon = True
+        self.collector.start()
+
+    def submit(self, path, data, start = 0, stop = None, mark = None):
+        """Hands the lines in data[start:stop] to the worker for this path,
+        holding their checkpoint mark until the worker has parsed them.
+        Blocks while that worker is behind."""
+        if start or stop is not None:
+            data = data[start:stop]
+        if mark is not None:
+            checkpoints.hold({mark: 1})
+        self.inputs[hash(path) % len(self.inputs)].put((path, data, 0, None, mark))
+
+    def collect(self, shipper):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            js_arr, counts, marks, chunks = result
+            metrics.merge(counts)
+            if checkpoints:
+                # The documents hold their marks before the chunks let go
+                checkpoints.hold(marks)
+                checkpoints.release(chunks)
+            if js_arr:
+                shipper.submit(None, js_arr, marks)
+
+    def stop(self):
+        """Flushes and stops the workers, then waits for their last batches
+        to be handed to the shipper."""
+        for inbox in self.inputs:
+            inbox.put(None)
+        for proc in self.procs:
+            proc.join()
+        self.results.put(None)
+        if self.collector:
+            self.collector.join()
+
+
+def start_parsers():
+    global parsers
+    workers = config_option('Analyzer', 'parsers', 0)
+    if workers > 0:
+        parsers = ParserPool(workers, interval = config_option('Analyzer', 'flush', 15.0))
+    return parsers
+
+
+# Mask names whose order relative to other events on the same path matters.
+# Anything else (modify, create, open, access...) can be merged.
+barrier_masks = set([u'IN_MOVED_FROM', u'IN_MOVED_TO', u'IN_DELETE', u'IN_DELETE_SELF',
+                     u'IN_MOVE_SELF', u'IN_CLOSE_WRITE', u'IN_Q_OVERFLOW', u'IN_IGNORED'])
+
+
+class EventCoalescer:
+    """Collapses the inotify events read in one tick into as few events per
+    path as possible. A creation followed by any number of modifications
+    becomes a single event, so each file is read once per tick no matter
+    how many writes it saw. Moves, deletes and close-after-write are kept
+    in order, as they change what the events after them mean."""
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.events_in = 0
+        self.events_out = 0
+        self.reads_out = 0
+
+    def add(self, path, masks):
+        self.events_in += 1
+        masks = set(masks)
+        queue = self.pending.setdefault(path, [])
+        if queue and not (masks & barrier_masks) and not (queue[-1] & barrier_masks):
+            queue[-1] |= masks
+        else:
+            queue.append(masks)
+
+    def flush(self):
+        """Returns the coalesced (path, masks) events and forgets them."""
+        out = []
+        for path, queue in self.pending.items():
+            for masks in queue:
+                out.append((path, masks))
+        self.pending.clear()
+        self.events_out += len(out)
+        return out
+
+    def report(self):
+        syslog.syslog(syslog.LOG_INFO, "inotify events in: %u, after coalescing: %u, reads: %u" % (self.events_in, self.events_out, self.reads_out))
+
+
+# How much to read from a file at once.
+readsize = 1024 * 1024
+
+
+class Tailer:
+    """Follows a single file. New data is read in large chunks and handed
+    to the parser by offset, with no per-line copies. A trailing partial
+    line is held back until the rest of it has been written. What is parsed
+    is counted against the checkpoint `mark`, if there is one."""
+
+    def __init__(self, path, fh, parse = None):
+        self.path = path
+        self.fh = fh
+        self.parse = parse or parseLine
+        self.partial = ""
+        self.bytes_read = 0
+        self.mark = None
+
+    def process(self):
+        """Reads and parses everything appended since the last call, a chunk
+        at a time, so each chunk is parsed straight from the string read()
+        returned. Returns the number of bytes read."""
+        nbytes = 0
+        while True:
+            data = self.fh.read(readsize)
+            if not data:
+                break
+            nbytes += self.feed(data)
+            if len(data) < readsize:
+                break
+        return nbytes
+
+    def feed(self, data):
+        """Parses the complete lines in data, which follows whatever was
+        fed before. Returns the number of bytes fed."""
+        self.bytes_read += len(data)
+        last = data.rfind("\n")
+        if last == -1:
+            self.partial += data
+            return len(data)
+        start = 0
+        if self.partial:
+            start = data.find("\n") + 1
+            self.parse(self.path, self.partial + data[:start], 0, None, self.mark)
+        self.parse(self.path, data, start, last, self.mark)
+        self.partial = data[last+1:]
+        return len(data)
+
+    def lag(self):
+        """Number of bytes in the file we have not parsed yet."""
+        return os.fstat(self.fh.fileno()).st_size - self.tell()
+
+    def tell(self):
+        """Offset of the first byte not yet parsed."""
+        return self.fh.tell() - len(self.partial)
+
+    def seek(self, offset, whence = 0):
+        self.partial = ""
+        self.fh.seek(offset, whence)
+
+    def finish(self):
+        """Parses a held back last line that never got its line feed."""
+        if self.partial:
+            self.parse(self.path, self.partial, 0, None, self.mark)
+            self.partial = ""
+
+    def untrack(self):
+        """Stops checkpointing the file, as it is no longer ours to resume."""
+        if self.mark is not None:
+            checkpoints.abandon(self.mark, marked.pop(self.mark, 0))
+            self.mark = None
+
+    def close(self):
+        self.untrack()
+        self.fh.close()
+
+
+def checkpoint(path, inode):
+    """Ends the checkpoint mark of a file at the offset read up to, once
+    what was read has been parsed, and starts a new one."""
+    if checkpoints:
+        tailer = filehandles[path]
+        checkpoints.close(tailer.mark, tailer.tell(), marked.pop(tailer.mark, 0))
+        tailer.mark = checkpoints.open(path, inode)
+
+
+# Rotated files still being read, by inode: [tailer, time of last data]
+draining = {}
+
+def drain_rotated(path):
+    """Called when a file we follow is renamed away, as logrotate does. The
+    writer keeps appending to the old inode until it reopens its log, so
+    rather than closing it we keep reading it (under its original path)
+    until it has been quiet for [Analyzer] drain seconds. The inode stays
+    in inodes meanwhile, so it is not opened again under its new name."""
+    tailer = filehandles.pop(path)
+    inode = inodes_path.pop(path)
+    tailer.untrack()
+    draining[inode] = [tailer, time.time()]
+    print("%s was rotated, draining it" % path)
+    drain_pending()
+
+
+def drain_pending():
+    """Reads whatever has been appended to rotated files, and closes those
+    that have been quiet for long enough."""
+    grace = config_option('Analyzer', 'drain', 30)
+    for inode, entry in list(draining.items()):
+        tailer = entry[0]
+        try:
+            if tailer.process():
+                entry[1] = time.time()
+                continue
+            if time.time() < entry[1] + grace:
+                continue
+            tailer.finish()
+        except Exception as err:
+            print(err)
+        tailer.close()
+        del draining[inode]
+        inodes.pop(inode, None)
+        print("Done draining %s (%u)" % (tailer.path, inode))
+
+
+def backfill(filenames):
+    """Streams rotated logs (gzipped or not) through the parser and ships
+    them, to reindex logs we missed or lost. Files are decompressed in a
+    thread of their own, a few chunks ahead of the parser (zlib does not
+    hold the GIL while it works), so with parser processes this runs at
+    about the speed of the disk. Documents carry the path of the live log,
+    e.g. access.log for access.log.2.gz. Sampling does not apply here."""
+    start_rollup()
+    start_geoip()
+    start_parsers()
+    shipper = start_shipper(connect_sink(config))
+    if parsers:
+        parsers.start(shipper)
+    chunks = Queue.Queue(16)
+
+    def decompress():
+        for filename in filenames:
+            try:
+                fh = gzip.open(filename, "rb") if filename.endswith(".gz") else open(filename, "rb")
+                while True:
+                    data = fh.read(readsize)
+                    if not data:
+                        break
+                    chunks.put((filename, data))
+                fh.close()
+            except Exception as err:
+                print("Could not read %s: %s" % (filename, err))
+            chunks.put((filename, None))
+        chunks.put(None)
+
+    reader = Thread(target = decompress)
+    reader.daemon = True
+    reader.start()
+    start = time.time()
+    nbytes = 0
+    tailer = None
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            filename, data = item
+            if data is None:
+                # A missing, unreadable or empty file never got a tailer
+                if tailer:
+                    tailer.finish()
+                    print("Backfilled %s: %u MB" % (filename, tailer.bytes_read / 1048576))
+                    tailer = None
+            else:
+                if not tailer:
+                    path = re.sub(r"(\.\d+)?(\.gz)?$", "", filename)
+                    tailer = Tailer(path, None, parsers.submit if parsers else None)
+                nbytes += tailer.feed(data)
+            flush_pending(shipper)
+    finally:
+        # Ship whatever was parsed so far, even if we are bailing out
+        flush_pending(shipper, True)
+        if parsers:
+            parsers.stop()
+        shipper.stop()
+    spent = time.time() - start
+    print("Backfilled %u files, %u MB in %.2fs: %.1f MB/sec" % (len(filenames), nbytes / 1048576, spent, nbytes / 1048576.0 / max(spent, 0.001)))
+
 
 def connect_es(config):
     esa = []
@@ -439,10 +2074,25 @@ def connect_es(config):
     return esx
 
 
-def parseLine(path, data):
+def parseLine(path, data, start = 0, stop = None, mark = None):
+    """Parses the lines in data[start:stop]. Lines are matched in place by
+    offset, so the only copies made are of the fields we keep. Documents
+    are tagged with the checkpoint `mark` the lines were read under."""
     global json_pending, config
-    for line in (l.rstrip() for l in data.split("\n")):
-        m = re.match(r"^<%JSON:([^>%]+)%>\s*(.+)", line)
+    if stop is None:
+        stop = len(data)
+    nlines = 0
+    matched = {}
+    pos = start
+    while pos < stop:
+        nlines += 1
+        eol = data.find("\n", pos, stop)
+        if eol == -1:
+            eol = stop
+        end = eol
+        while end > pos and data[end-1].isspace():
+            end -= 1
+        m = json_regex.match(data, pos, end) if data[pos] == '<' else None
         if m:
             try:
                 # Try normally
@@ -454,295 +2104,584 @@ def parseLine(path, data):
                 js['filepath'] = path
                 js['timestamp'] = time.time()
                 js['logtype'] = m.group(1)
-                if not js['logtype'] in json_pending:
-                    json_pending[js['logtype']] = []
-                    last_push[js['logtype']] = time.time()
-                    print("got our first valid json as " + js['logtype'] + "!")
-                json_pending[js['logtype']].append(js)
+                sampler = samplers.get(js['logtype'])
+                rate = sampler.keep(str(js.get('status', ''))) if sampler else None
+                if not sampler or rate:
+                    if sampler:
+                        sampler.stamp(js, rate)
+                    if not js['logtype'] in json_pending:
+                        json_pending[js['logtype']] = []
+                        last_push[js['logtype']] = time.time()
+                        print("got our first valid json as " + js['logtype'] + "!")
+                    if mark is not None:
+                        js['_mark'] = mark
+                        marked[mark] = marked.get(mark, 0) + 1
+                    json_pending[js['logtype']].append(js)
+                    matched[js['logtype']] = matched.get(js['logtype'], 0) + 1
             except:
                 pass
         else:
-            for r in regexes:
-                match = regexes[r].match(line)
-                if match:
-                    if not r == 'apache_access':
-                        print("Found a " + r + " match")
-                    js = tuples[r]( filepath=path, logtype=r, timestamp = time.time() , **match.groupdict())
-                    json_pending[r].append(js._asdict())
-                    if not r == 'apache_access':
-                        print("Appended a " + r + " match")
+            r, match = classifier.classify(path, data, pos, end)
+            sampler = samplers.get(r) if match else None
+            if sampler:
+                rate = sampler.keep(match.group('status') if sampler.has_status else None)
+                if not rate:
+                    match = None
+            if match:
+                if debug:
+                    print("Found a " + r + " match")
+                # A plain dict is much cheaper to build (and to pickle, with
+                # parser processes) than the namedtuple's OrderedDict.
+                js = match.groupdict()
+                if sampler:
+                    sampler.stamp(js, rate)
+                js['filepath'] = path
+                js['logtype'] = r
+                js['timestamp'] = time.time()
+                if mark is not None:
+                    js['_mark'] = mark
+                    marked[mark] = marked.get(mark, 0) + 1
+                json_pending[r].append(js)
+                matched[r] = matched.get(r, 0) + 1
+        pos = eol + 1
+    metrics.count_lines(nlines, matched)
+
+
+def benchmark_parser(nlines):
+    """Replays a mixed corpus through the old and the new line dispatcher
+    and reports lines/sec for each."""
+    samples = [
+        (90, '10.0.0.%u - - [01/Jan/2017:00:00:00 +0000] "GET /index.html HTTP/1.1" 200 1234 "-" "Mozilla/5.0"'),
+        (3, 'Jan  1 00:00:%02u host sshd[123]: Accepted publickey for root'),
+        (2, '[Sun Jan 01 00:00:00 2017] [error] [pid %u] [client 10.0.0.1:1234] File does not exist'),
+        (1, '2017-01-01 00:00:%02u,123 fail2ban.actions: WARNING Ban 10.0.0.1'),
+        (1, '2017/01/01 00:00:%02u [1234] rsync on foo from bar'),
+        (1, '@4000000058685c80%04x delivery 1: success'),
+        (1, '<%%JSON:httpd_access%%> {"vhost": "www.apache.org", "bytes": "%u"}'),
+        (1, 'this line matches nothing at all %u')
+    ]
+    corpus = []
+    for weight, fmt in samples:
+        corpus += [fmt % (i % 60) for i in range(weight)]
+    random.seed(0)
+    random.shuffle(corpus)
+    lines = [corpus[i % len(corpus)] for i in range(nlines)]
+
+    def before(path, line):
+        if re.match(r"^<%JSON:([^>%]+)%>\s*(.+)", line):
+            return
+        for r in regexes:
+            if regexes[r].match(line):
+                return
+
+    def after(path, line):
+        if line[0] == '<' and json_regex.match(line):
+            return
+        classifier.classify(path, line)
+
+    for name, func in [('before', before), ('after', after)]:
+        start = time.time()
+        for line in lines:
+            func('/var/log/bench.log', line)
+        spent = time.time() - start
+        print("%-6s: %u lines in %.2fs, %u lines/sec" % (name, nlines, spent, nlines / spent))
+
+
+benchmark_line = '10.0.0.1 - - [01/Jan/2017:00:00:00 +0000] "GET /index.html HTTP/1.1" 200 1234 "-" "Mozilla/5.0"\n'
+benchmark_block = benchmark_line * (1024 * 1024 / len(benchmark_line))
+
+def write_benchmark_log(size, n = 0):
+    """Writes a synthetic access log of `size` MB, returns its file name."""
+    filename = "/tmp/loggy-benchmark-%u-%u.log" % (os.getpid(), n)
+    print("Writing %u MB of access log to %s..." % (size, filename))
+    with open(filename, "w") as f:
+        for i in range(size):
+            f.write(benchmark_block)
+    return filename
+
+
+def benchmark_tailer(size):
+    """Writes a synthetic access log of `size` MB and reads it back through
+    the old readline() path and through Tailer, reporting MB/sec for each.
+    Lines are classified but not queued for shipping."""
+    filename = write_benchmark_log(size)
+    nbytes = os.path.getsize(filename)
+    block = benchmark_block
+
+    def before(fh):
+        while True:
+            rd = 0
+            data = ""
+            while rd < len(block):
+                line = fh.readline()
+                if not line:
                     break
+                rd += len(line)
+                data += line
+            if not rd:
+                break
+            for line in (l.rstrip() for l in data.split("\n")):
+                if line[:1] == '<' and json_regex.match(line):
+                    continue
+                classifier.classify(filename, line)
 
-if osname == "freebsd":
-    class BSDHandler(PatternMatchingEventHandler):
-        def process(self, event):
-            global filehandles, inodes, inodes_path
-            path = event.src_path
-            if (event.event_type == 'moved') and (path in filehandles):
-                print("File moved, closing original handle")
-                try:
-                    filehandles[path].close()
-                except Exception as err:
-                    print(err)
-                del filehandles[path]
-                inode = inodes_path[path]
-                del inodes[inode]
+    def classify(path, data, start = 0, stop = None, mark = None):
+        if stop is None:
+            stop = len(data)
+        pos = start
+        while pos < stop:
+            eol = data.find("\n", pos, stop)
+            if eol == -1:
+                eol = stop
+            if data[pos] == '<' and json_regex.match(data, pos, eol):
+                pass
+            else:
+                classifier.classify(path, data, pos, eol)
+            pos = eol + 1
+
+    def after(fh):
+        tailer = Tailer(filename, fh, classify)
+        while tailer.process():
+            pass
+
+    try:
+        for name, func in [('before', before), ('after', after)]:
+            with open(filename, "r") as fh:
+                start = time.time()
+                func(fh)
+                spent = time.time() - start
+            print("%-6s: %u MB in %.2fs, %.1f MB/sec" % (name, nbytes / 1048576, spent, nbytes / 1048576.0 / spent))
+    finally:
+        os.unlink(filename)
+
+
+def benchmark_pipeline(size, workers):
+    """Runs a synthetic access log of `size` MB through the whole pipeline
+    (tailing, parsing, enrichment and shipping) into a FileSink in a scratch
+    directory, so no ElasticSearch is involved, and reports docs/sec. With
+    `workers` > 0, parsing is done by a ParserPool of that many processes,
+    and the log is split across as many files, as each file is only ever
+    parsed by one worker."""
+    global parsers
+    nfiles = max(1, workers)
+    filenames = [write_benchmark_log(size / nfiles, n) for n in range(nfiles)]
+    nbytes = sum(os.path.getsize(filename) for filename in filenames)
+    ndocs = nbytes / len(benchmark_line)
+    outdir = filenames[0] + ".out"
+    if workers > 0:
+        parsers = ParserPool(workers)
+    shipper = ShipperPool(FileSink(outdir))
+    if parsers:
+        parsers.start(shipper)
+    try:
+        start = time.time()
+        tailers = [Tailer(filename, open(filename, "r"), parsers.submit if parsers else None) for filename in filenames]
+        while tailers:
+            for tailer in list(tailers):
+                if not tailer.process():
+                    tailer.close()
+                    tailers.remove(tailer)
+            flush_pending(shipper)
+        flush_pending(shipper, True)
+        if parsers:
+            parsers.stop()
+        shipper.stop()
+        spent = time.time() - start
+        print("%u MB, %u docs in %.2fs: %.1f MB/sec, %u docs/sec" % (nbytes / 1048576, ndocs, spent, nbytes / 1048576.0 / spent, ndocs / spent))
+        written = 0
+        for name in os.listdir(outdir):
+            with gzip.open(os.path.join(outdir, name), 'rb') as f:
+                for line in f:
+                    if json.loads(line)['_type'] == 'apache_access':
+                        written += 1
+        print("Read back %u docs from %s" % (written, outdir))
+        if written != ndocs:
+            print("Expected %u docs, %u went missing!" % (ndocs, ndocs - written))
+            sys.exit(1)
+    finally:
+        for filename in filenames:
+            os.unlink(filename)
+        shutil.rmtree(outdir, True)
+
+
+def benchmark_geoip(filename, nlines, ipfile = None):
+    """Looks up `nlines` client IPs in the GeoIP database `filename` with and
+    without the LRU cache, and reports lookups/sec for each. The IPs are
+    read from `ipfile` (one per line, e.g. the first column of an access
+    log) if given, or else drawn from 100k random addresses with the long
+    tail seen in real access logs: a few clients make most requests."""
+    if ipfile:
+        with open(ipfile) as f:
+            ips = [line.split(" ", 1)[0].strip() for line in f][:nlines]
+    else:
+        pool = ["%u.%u.%u.%u" % (random.randint(1, 223), random.randint(0, 255), random.randint(0, 255), random.randint(1, 254)) for i in range(100000)]
+        ips = [pool[min(int(random.paretovariate(1.0)) - 1, len(pool) - 1)] if random.random() < 0.9 else random.choice(pool) for i in range(nlines)]
+    print("%u lookups, %u distinct IPs" % (len(ips), len(set(ips))))
+    for name, cachesize in [('uncached', 0), ('cached', 10000)]:
+        g = GeoIP(filename, cachesize)
+        lookup = g.lookup if cachesize else g.find
+        start = time.time()
+        for ip in ips:
+            lookup(ip)
+        spent = time.time() - start
+        print("%-8s: %u lookups/sec, cache hit rate %.1f%%" % (name, len(ips) / spent, 100.0 * g.hits / max(1, g.hits + g.misses)))
+
+
+def benchmark_burst(nlines):
+    """Feeds a burst of `nlines` access log lines, 1% of them 404s, through
+    parseLine as fast as possible with apache_access capped at 1000 lines/sec
+    (errors always kept), and reports how many were kept and how large
+    json_pending and the process got, to show that a burst stays bounded.
+    Fails unless every 404 was kept at rate 1.0, no more than the cap got
+    through, and the kept documents weighed by 1/sample_rate add back up to
+    the lines offered."""
+    import resource
+    samplers['apache_access'] = Sampler('apache_access', cap = 1000, keep_errors = True)
+    chunk = "".join(benchmark_line if i % 100 else benchmark_line.replace(" 200 ", " 404 ") for i in range(1000))
+    nlines -= nlines % 1000
+    peak = 0
+    kept = 0
+    errors = 0
+    weight = 0.0
+    start = time.time()
+    for i in range(nlines / 1000):
+        parseLine('/var/log/bench.log', chunk)
+        pending = len(json_pending['apache_access'])
+        peak = max(peak, pending)
+        if pending >= 500 or i == nlines / 1000 - 1:
+            for js in take_pending('apache_access'):
+                kept += 1
+                weight += 1.0 / js['sample_rate']
+                if js['status'] == '404':
+                    errors += 1
+                    if js['sample_rate'] != 1.0:
+                        print("FAIL: a 404 was stamped with sample_rate %f" % js['sample_rate'])
+                        sys.exit(1)
+    spent = time.time() - start
+    print("Offered %u lines in %.2fs, kept %u (%u/sec), peak pending: %u, max RSS: %u MB" % (
+        nlines, spent, kept, kept / spent, peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    print("Kept all %u of %u errors, weighed back up to %.0f lines" % (errors, nlines / 100, weight))
+    if errors != nlines / 100:
+        print("FAIL: only %u of %u errors were kept" % (errors, nlines / 100))
+        sys.exit(1)
+    if kept - errors > 1000 * (spent + 1):
+        print("FAIL: kept %u lines in %.2fs, over the cap of 1000/sec" % (kept - errors, spent))
+        sys.exit(1)
+    if abs(weight - nlines) > nlines * 0.001:
+        print("FAIL: kept documents weigh up to %.0f lines, not %u" % (weight, nlines))
+        sys.exit(1)
+
+
+def handle(path, masks):
+    """Acts on one (coalesced) event for a path, given as inotify mask names:
+    starts following new logs, reads modified ones and lets go of those that
+    were rotated or deleted. Returns True if the file was read."""
+    if (u'IN_MOVED_FROM' in masks) and (path in filehandles):
+        drain_rotated(path)
+        
+    elif (not u'IN_DELETE' in masks) and (not path in filehandles) and (path.find(".gz") == -1):
+        try:
+            print("Opening " + path)
+            idata = os.stat(path)
+            inode = idata.st_ino
+            if not inode in inodes:
+                filehandles[path] = open_tail(path, inode, u'IN_CREATE' in masks)
+                print("Started watching " + path)
+                inodes[inode] = path
+                inodes_path[path] = inode
+                
+        except Exception as err:
+            print(err)
+            try:
+                filehandles[path].close()
+            except Exception as err:
+                print(err)
+            del filehandles[path]
+            inode = inodes_path[path]
+            del inodes[inode]
+            
+    # File truncated?
+    if u'IN_CLOSE_WRITE' in masks and path in filehandles:
+    #    print(path + " truncated!")
+        filehandles[path].seek(0,2)
+        
+    # File contents modified? Coalesced events may also carry
+    # IN_CREATE or IN_CLOSE_NOWRITE, but a modify wins.
+    elif u'IN_MODIFY' in masks and path in filehandles:
+  #      print(path + " was modified")
+        try:
+            filehandles[path].process()
+            checkpoint(path, inodes_path[path])
+            return True
+        except Exception as err:
+            try:
+                print("Could not utilize " + path + ", closing.." + err)
+                filehandles[path].close()
+            except Exception as err:
+                print(err)
+            del filehandles[path]
+            inode = inodes_path[path]
+            del inodes[inode]
     
-            elif (event.event_type == 'modified' or event.event_type == 'created') and (path.find(".gz") == -1) and not path in filehandles:
+    # File deleted? (close handle)
+    elif u'IN_DELETE' in masks:
+        if path in filehandles:
+            print("Closed " + path)
+            try:
+                filehandles[path].close()
+            except Exception as err:
+                print(err)
+            del filehandles[path]
+            inode = inodes_path[path]
+            del inodes[inode]
+            print("Stopped watching " + path)
+    return False
+
+
+class InotifyWatcher:
+    """Watches directories (recursively) with inotify, on Linux."""
+
+    def __init__(self, paths):
+        self.w = watcher.AutoWatcher()
+        for path in paths:
+            try:
+                print("Recursively monitoring " + path + "...")
+                self.w.add_all(path, inotify.IN_ALL_EVENTS)
+            except OSError as err:
+                pass
+        self.poll = select.poll()
+        self.poll.register(self.w, select.POLLIN)
+
+    def watches(self):
+        return self.w.num_watches()
+
+    def read(self, timeout):
+        """Waits up to `timeout` seconds for events and returns them as
+        (path, mask names) pairs."""
+        events = []
+        if self.poll.poll(timeout * 1000):
+            for evt in self.w.read(0):
+                masks = inotify.decode_mask(evt.mask)
+                if not u'IN_ISDIR' in masks:
+                    events.append((evt.fullpath, masks))
+        return events
+
+
+class KqueueWatcher:
+    """Watches directories (recursively) with kqueue, on FreeBSD. kqueue
+    reports changes to open descriptors rather than to names, so every
+    directory and file below the paths is opened for it. A write to a
+    directory means entries came or went, which we find out by scanning it
+    again. Events are passed on under the inotify mask names that handle()
+    understands."""
+
+    file_flags = getattr(select, 'KQ_NOTE_WRITE', 0) | getattr(select, 'KQ_NOTE_EXTEND', 0) | \
+                 getattr(select, 'KQ_NOTE_DELETE', 0) | getattr(select, 'KQ_NOTE_RENAME', 0)
+
+    def __init__(self, paths):
+        self.kq = select.kqueue()
+        self.fds = {}
+        self.paths = {}
+        self.entries = {}
+        for path in paths:
+            if os.path.isdir(path):
+                print("Recursively monitoring " + path + "...")
+                self.scan(path)
+
+    def watches(self):
+        return len(self.fds)
+
+    def watch(self, path, flags):
+        fd = os.open(path, os.O_RDONLY)
+        self.kq.control([select.kevent(fd, select.KQ_FILTER_VNODE, select.KQ_EV_ADD | select.KQ_EV_CLEAR, flags)], 0, 0)
+        self.fds[fd] = path
+        self.paths[path] = fd
+
+    def unwatch(self, path):
+        # Closing the descriptor also drops its kevent.
+        fd = self.paths.pop(path, None)
+        if fd is not None:
+            del self.fds[fd]
+            os.close(fd)
+        for sub in self.entries.pop(path, {}):
+            self.unwatch(os.path.join(path, sub))
+
+    def scan(self, directory, events = None):
+        """Watches whatever is new in a directory, and below it. New files
+        are added to `events` as created (and modified, so that whatever
+        they already hold is read)."""
+        try:
+            names = os.listdir(directory)
+            if not directory in self.paths:
+                self.watch(directory, select.KQ_NOTE_WRITE)
+        except OSError:
+            self.unwatch(directory)
+            return
+        known = self.entries.get(directory, {})
+        seen = {}
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            seen[name] = st.st_ino
+            if known.get(name) == st.st_ino:
+                continue
+            self.unwatch(path)
+            if stat.S_ISDIR(st.st_mode):
+                self.scan(path, events)
+            elif stat.S_ISREG(st.st_mode):
+                self.watch(path, self.file_flags)
+                if events is not None:
+                    events.append((path, [u'IN_CREATE', u'IN_MODIFY']))
+        for name in set(known) - set(seen):
+            self.unwatch(os.path.join(directory, name))
+        self.entries[directory] = seen
+
+    def read(self, timeout):
+        """Waits up to `timeout` seconds for events and returns them as
+        (path, mask names) pairs."""
+        events = []
+        rescan = []
+        for kev in self.kq.control(None, 256, timeout):
+            path = self.fds.get(kev.ident)
+            if path is None:
+                continue
+            if path in self.entries:
+                rescan.append(path)
+                continue
+            if kev.fflags & (select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND):
+                events.append((path, [u'IN_MODIFY']))
+            if kev.fflags & select.KQ_NOTE_RENAME:
+                events.append((path, [u'IN_MOVED_FROM']))
+                self.unwatch(path)
+            elif kev.fflags & select.KQ_NOTE_DELETE:
+                events.append((path, [u'IN_DELETE']))
+                self.unwatch(path)
+        # Directories are scanned after the file events are in, so that a
+        # rotated log is let go of before its successor is opened.
+        for directory in rescan:
+            self.scan(directory, events)
+        return events
+
+
+class EventLoop:
+    """Main loop of loggy, the same on every platform: waits for events from
+    the watcher, coalesces them for up to `window` ms, hands them to
+    handle(), and every `tick` ms flushes pending documents, drains rotated
+    logs, syncs checkpoints and emits metrics. All waiting is done in
+    poll()/kevent() (or a sleep while a coalescing window is open), so with
+    a short [Analyzer] flush and tick loggy can ship within 100ms of a line
+    being written and still sit idle when nothing happens."""
+
+    def __init__(self, watcher, shipper, window = 1000, tick = 500):
+        self.watcher = watcher
+        self.shipper = shipper
+        self.window = window / 1000.0
+        self.tick = tick / 1000.0
+        self.coalescer = EventCoalescer()
+        self.deadline = None
+        self.next_tick = time.time() + self.tick
+        self.last_report = time.time()
+
+    def run(self):
+        while not stopping.is_set():
+            self.run_once()
+        self.finish()
+
+    def run_once(self):
+        """Waits for events until the coalescing window or the next tick is
+        over, acts on what came in and runs the timers if they are due."""
+        now = time.time()
+        if self.deadline is not None:
+            # Let more events pile up in the kernel until the window is over.
+            wait = min(self.deadline, self.next_tick) - now
+            if wait > 0:
+                time.sleep(wait)
+            timeout = 0
+        else:
+            timeout = max(0, self.next_tick - now)
+        for path, masks in self.watcher.read(timeout):
+            if self.deadline is None:
+                self.deadline = time.time() + self.window
+            self.coalescer.add(path, masks)
+
+        # Everything read in this window is now collapsed into as few
+        # events per path as possible before we act on it.
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.deadline = None
+            for path, masks in self.coalescer.flush():
                 try:
-                    idata = os.stat(path)
-                    inode = idata.st_ino
-                    if not inode in inodes:
-                        print("Opening: " + path)
-                        filehandles[path] = open(path, "r")
-                        print("Started watching %s (%u)" % (path, inode))
-                        filehandles[path].seek(0,2)
-                        inodes[inode] = path
-                        inodes_path[path] = inode
-                        print(path, filehandles[path])
+                    if handle(path, masks):
+                        self.coalescer.reads_out += 1
                 except Exception as err:
                     print(err)
-            elif event.event_type == 'modified' and path in filehandles:
-                print(path + " was modified")
-                rd = 0
-                data = ""
-                #print("Change in " + path)
-                try:
-                    while True:
-                        line = filehandles[path].readline()
-                        if not line:
-                            #filehandles[path].seek(0,2)
-                            break
-                        else:
-                            rd += len(line)
-                            data += line
-                    #print("Read %u bytes from %s" % (rd, path))
-                    parseLine(path, data)
-                except Exception as err:
-                    try:
-                        print("Could not utilize " + path + ", closing.." + err)
-                        filehandles[path].close()
-                    except Exception as err:
-                        print(err)
-                    del filehandles[path]
-                    inode = inodes_path[path]
-                    del inodes[inode]
-          # File deleted? (close handle)
-            elif event.event_type == 'deleted':
-                if path in filehandles:
-                    print("Closed " + path)
-                    try:
-                        filehandles[path].close()
-                    except Exception as err:
-                        print(err)
-                    del filehandles[path]
-                    inode = inodes_path[path]
-                    del inodes[inode]
-                    print("Stopped watching " + path)
-                    
-            
-        def on_modified(self, event):
-            self.process(event)
-        def on_created(self, event):
-            self.process(event)
-        def on_deleted(self, event):
-            self.process(event)
-        def on_moved(self, event):
-            self.process(event)
+
+        if time.time() >= self.next_tick:
+            self.timers()
+            self.next_tick = time.time() + self.tick
+
+    def finish(self):
+        """Ships (or spools) everything read so far, then saves checkpoints,
+        so the next loggy starts right after the last line this one shipped."""
+        print("Stopping, shipping what is pending...")
+        if draining:
+            drain_pending()
+        flush_pending(self.shipper, True)
+        if parsers:
+            parsers.stop()
+        self.shipper.stop()
+        if checkpoints:
+            for path in list(filehandles):
+                checkpoint(path, inodes_path[path])
+            checkpoints.sync(True)
+
+    def timers(self):
+        if draining:
+            drain_pending()
+        flush_pending(self.shipper)
+        if time.time() > (self.last_report + 60):
+            self.shipper.report()
+            self.coalescer.report()
+            self.last_report = time.time()
+        emit_metrics()
+        if checkpoints:
+            checkpoints.sync()
+
+
+# Set on SIGTERM (or ^C): the event loop then ships what it has and returns.
+stopping = Event()
+
+def stop_loggy(signum, frame):
+    stopping.set()
+
 
 class Loggy(Thread):
     def run(self):
-        global timeout, w, tuples, regexes, json_pending, last_push, config
-        fp = {}
-        if osname == "linux":
-            w = watcher.AutoWatcher()
-            for path in config.get('Analyzer','paths').split(","):
-                try:
-                    print("Recursively monitoring " + path.strip() + "...")
-                    w.add_all(path.strip(), inotify.IN_ALL_EVENTS)
-                except OSError as err:
-                    pass
-                
-            if not w.num_watches():
-                print("No paths to analyze, nothing to do!")
-                sys.exit(1)
-            
-            poll = select.poll()
-            poll.register(w, select.POLLIN)
-            
-            timeout = None
-            
-            threshold = watcher.Threshold(w, 256)
-    
-            inodes = {}
-            inodes_path = {}
-            xes = connect_es(config)
-            while True:
-                events = poll.poll(timeout)
-                nread = 0
-                if threshold() or not events:
-                    #print('reading,', threshold.readable(), 'bytes available')
-                    for evt in w.read(0):
-                        nread += 1
-            
-                        # The last thing to do to improve efficiency here would be
-                        # to coalesce similar events before passing them up to a
-                        # higher level.
-            
-                        # For example, it's overwhelmingly common to have a stream
-                        # of inotify events contain a creation, followed by
-                        # multiple modifications of the created file.
-            
-                        # Recognising this pattern (and others) and coalescing
-                        # these events into a single creation event would reduce
-                        # the number of trips into our app's presumably more
-                        # computationally expensive upper layers.
-                        masks = inotify.decode_mask(evt.mask)
-                        #print(masks)
-                        path = evt.fullpath
-                        #print(repr(evt.fullpath), ' | '.join(masks))
-                        try:
-                            if not u'IN_ISDIR' in masks:
-                                
-                                if (u'IN_MOVED_FROM' in masks) and (path in filehandles):
-                                    print("File moved, closing original handle")
-                                    try:
-                                        filehandles[path].close()
-                                    except Exception as err:
-                                        print(err)
-                                    del filehandles[path]
-                                    inode = inodes_path[path]
-                                    del inodes[inode]
-                                    
-                                elif (not u'IN_DELETE' in masks) and (not path in filehandles) and (path.find(".gz") == -1):
-                                    try:
-                                        print("Opening " + path)
-                                        idata = os.stat(path)
-                                        inode = idata.st_ino
-                                        if not inode in inodes:
-                                            filehandles[path] = open(path, "r")
-                                            print("Started watching " + path)
-                                            filehandles[path].seek(0,2)
-                                            inodes[inode] = path
-                                            inodes_path[path] = inode
-                                            
-                                    except Exception as err:
-                                        print(err)
-                                        try:
-                                            filehandles[path].close()
-                                        except Exception as err:
-                                            print(err)
-                                        del filehandles[path]
-                                        inode = inodes_path[path]
-                                        del inodes[inode]
-                                        
-                                # First time we've discovered this file?
-                                if u'IN_CLOSE_NOWRITE' in masks and not path in filehandles:
-                                    pass
-                                        
-                                # New file created in a folder we're watching??
-                                elif u'IN_CREATE' in masks:
-                                    pass
-                                
-                                # File truncated?
-                                elif u'IN_CLOSE_WRITE' in masks and path in filehandles:
-                                #    print(path + " truncated!")
-                                    filehandles[path].seek(0,2)
-                                    
-                                # File contents modified?
-                                elif u'IN_MODIFY' in masks and path in filehandles:
-                              #      print(path + " was modified")
-                                    rd = 0
-                                    data = ""
-                                    #print("Change in " + path)
-                                    try:
-                                        while True:
-                                            line = filehandles[path].readline()
-                                            if not line:
-                                                #filehandles[path].seek(0,2)
-                                                break
-                                            else:
-                                                rd += len(line)
-                                                data += line
-                                        #print("Read %u bytes from %s" % (rd, path))
-                                        parseLine(path, data)
-                                    except Exception as err:
-                                        try:
-                                            print("Could not utilize " + path + ", closing.." + err)
-                                            filehandles[path].close()
-                                        except Exception as err:
-                                            print(err)
-                                        del filehandles[path]
-                                        inode = inodes_path[path]
-                                        del inodes[inode]
-                                
-                                
-                                # File deleted? (close handle)
-                                elif u'IN_DELETE' in masks:
-                                    if path in filehandles:
-                                        print("Closed " + path)
-                                        try:
-                                            filehandles[path].close()
-                                        except Exception as err:
-                                            print(err)
-                                        del filehandles[path]
-                                        inode = inodes_path[path]
-                                        del inodes[inode]
-                                        print("Stopped watching " + path)
-                                
-                                else:
-                                    pass
-                                
-                        except Exception as err:
-                            print(err)
-                            
-            
-                for x in json_pending:
-                    if (time.time() > (last_push[x] + 15)) or len(json_pending[x]) >= 500:
-                        if not x in fp:
-                            fp[x] = True
-                            print("First push for " + x + "!")
-                        t = NodeThread()
-                        t.assign(json_pending[x], x, xes)
-                        t.start()
-                        json_pending[x] = []
-                        last_push[x] = time.time()
-                    
-                if nread:
-                    #print('plugging back in')
-                    timeout = None
-                    poll.register(w, select.POLLIN)
-                else:
-                    #print('unplugging,', threshold.readable(), 'bytes available')
-                    timeout = 1000
-                    poll.unregister(w)
-        
+        watch = [path.strip() for path in config.get('Analyzer','paths').split(",")] if config.has_option('Analyzer', 'paths') else paths
         if osname == "freebsd":
-            xes = connect_es(config)
-            observer = Observer()
-            for path in paths:
-                observer.schedule(BSDHandler(), path, recursive=True)
-                syslog.syslog(syslog.LOG_INFO, "Recursively monitoring " + path.strip() + "...")
-            observer.start()
-            try:
-                while True:
-                    for x in json_pending:
-                        if not x in last_push:
-                            last_push[x] = time.time()
-                        if len(json_pending[x]) > 0 and ((time.time() > (last_push[x] + 15)) or len(json_pending[x]) >= 500):
-                            if not x in fp:
-                                fp[x] = True
-                                syslog.syslog(syslog.LOG_INFO, "First push for " + x + "!")
-                            t = NodeThread()
-                            t.assign(json_pending[x], x, xes)
-                            t.start()
-                            json_pending[x] = []
-                            last_push[x] = time.time()
-                    time.sleep(0.5)
-                    
-            except KeyboardInterrupt:
-                observer.stop()
-            observer.join()                
+            w = KqueueWatcher(watch)
+        else:
+            w = InotifyWatcher(watch)
+        if not w.watches():
+            print("No paths to analyze, nothing to do!")
+            sys.exit(1)
+        
+        start_samplers()
+        start_rollup()
+        start_geoip()
+        start_parsers()
+        shipper = start_shipper(connect_sink(config))
+        if parsers:
+            parsers.start(shipper)
+        start_metrics(shipper)
+        EventLoop(
+            w,
+            shipper,
+            window = config_option('Analyzer', 'coalesce', 1000),
+            tick = config_option('Analyzer', 'tick', 500)
+        ).run()
             
             
                 
@@ -758,8 +2697,26 @@ parser.add_argument('--daemonize', dest='daemon', action='store_true',
                    help='Run as a daemon')
 parser.add_argument('--stop', dest='kill', action='store_true',
                    help='Kill the currently running Loggy process')
+parser.add_argument('--debug', dest='debug', action='store_true',
+                   help='Print every line matched')
+parser.add_argument('--benchmark', dest='benchmark', type=str, choices=['parser', 'tailer', 'pipeline', 'burst', 'geoip'],
+                   help='Run a benchmark instead of Loggy')
+parser.add_argument('--lines', dest='lines', type=int, default=1000000,
+                   help='Number of log lines to use for benchmarks')
+parser.add_argument('--size', dest='size', type=int, default=5120,
+                   help='Size (in MB) of the log file to use for benchmarks')
+parser.add_argument('--parsers', dest='parsers', type=int, default=0,
+                   help='Number of parser processes to use for the pipeline benchmark')
+parser.add_argument('--geoip', dest='geoip', type=str, default='/usr/share/GeoIP/GeoLite2-City.mmdb',
+                   help='GeoIP database to use for the geoip benchmark')
+parser.add_argument('--ips', dest='ips', type=str,
+                   help='File of client IPs (one per line) to use for the geoip benchmark')
+parser.add_argument('--backfill', dest='backfill', type=str, nargs='+',
+                   help='Parse and ship these (rotated, possibly gzipped) log files, then exit')
 args = parser.parse_args()
 
+debug = args.debug
+
 pidfile = "/var/run/loggy.pid"
 if args.pidfile and len(args.pidfile) > 2:
     pidfile = args.pidfile
@@ -775,8 +2732,14 @@ def main():
         uid = pwd.getpwnam(args.user[0])[2]
         os.setuid(uid)
     
+    signal.signal(signal.SIGTERM, stop_loggy)
+    signal.signal(signal.SIGINT, stop_loggy)
     loggy = Loggy()
     loggy.start()
+    # Signals are only handled in the main thread, and not while it is
+    # blocked in a plain join(), so wait for loggy in short steps.
+    while loggy.is_alive():
+        loggy.join(1)
     
     
 ## Daemon class
@@ -789,6 +2752,16 @@ if args.kill:
     print("Stopping Loggy")
     daemon = MyDaemon(pidfile)
     daemon.stop()
+elif args.benchmark == 'parser':
+    benchmark_parser(args.lines)
+elif args.benchmark == 'tailer':
+    benchmark_tailer(args.size)
+elif args.benchmark == 'pipeline':
+    benchmark_pipeline(args.size, args.parsers)
+elif args.benchmark == 'burst':
+    benchmark_burst(args.lines)
+elif args.benchmark == 'geoip':
+    benchmark_geoip(args.geoip, args.lines, args.ips)
 else:
     config.read("loggy.cfg")
     if os.path.exists('/etc/dd-agent/datadog.conf'):
@@ -799,7 +2772,9 @@ else:
             mytags = tag_overrides[hostname]
     
     
-    if args.daemon:
+    if args.backfill:
+        backfill(args.backfill)
+    elif args.daemon:
         print("Daemonizing...")
         daemon = MyDaemon(pidfile)
         daemon.start(args)
@@ -22,6 +22,8 @@ class loggy (
       require => Package['gcc'];
     'certifi' :
       ensure  => present;
+    'maxminddb' :
+      ensure  => present;
   }
 
   -> file {
@@ -35,6 +37,11 @@ class loggy (
       mode   => '0755',
       owner  => $username,
       group  => $group;
+    '/var/spool/loggy':
+      ensure => directory,
+      mode   => '0700',
+      owner  => $username,
+      group  => $group;
     '/etc/init.d/loggy':
       mode   => '0755',
       owner  => $username,